@@ -1,6 +1,5 @@
 #!/bin/bash
 
-rm *.csv
 python ../src/summary.py ../output-robustness-single/ single robustness-single.csv
 python ../src/summary.py ../output-robustness-multi-u/ multi-u robustness-multi-u.csv
 python ../src/summary.py ../output-basedist-single/ single basedist-single.csv
@@ -0,0 +1,73 @@
+# %%
+import sys
+import time
+import numpy as np
+
+sys.path.append("../src")
+from experiment import (
+    new_rect,
+    new_obstacle_index,
+    polys_point_collision,
+    polys_rect_collision,
+)
+
+
+# %%
+def random_obstacles(num, field_size, size_obstacle, rng):
+    (fw, fh) = field_size
+    centers = rng.uniform([-fw / 2, -fh / 2], [fw / 2, fh / 2], (num, 2))
+    angles = rng.uniform(-180, 180, num)
+    return np.array(
+        [
+            new_rect(c, size_obstacle[0], size_obstacle[1], a)
+            for c, a in zip(centers, angles)
+        ]
+    )
+
+
+# %%
+def timeit(f, repeat):
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - started_at) / repeat
+
+
+# %%
+def bench(num, num_points, rng):
+    # Keep the obstacle density of a 600x400 field with 30 obstacles
+    scale = np.sqrt(num / 30)
+    field_size = (600 * scale, 400 * scale)
+    obstacles = random_obstacles(num, field_size, (40, 40), rng)
+    (fw, fh) = field_size
+    points = rng.uniform([-fw / 2, -fh / 2], [fw / 2, fh / 2], (num_points, 2))
+    rect = obstacles[0]
+
+    def linear_points():
+        chunk = max(1, 2 ** 22 // (num * 8))
+        for i in range(0, num_points, chunk):
+            polys_point_collision(obstacles, points[i : i + chunk]).any(axis=1)
+
+    build = timeit(lambda: new_obstacle_index(obstacles), 1)
+    point_collision, rect_collision = new_obstacle_index(obstacles)
+    return {
+        "build": build,
+        "points (linear)": timeit(linear_points, 3),
+        "points (index)": timeit(lambda: point_collision(points), 3),
+        "rect (linear)": timeit(lambda: polys_rect_collision(obstacles, rect).any(), 10),
+        "rect (index)": timeit(lambda: rect_collision(rect), 10),
+    }
+
+
+# %%
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    num_points = 1024
+    for i, num in enumerate([10, 100, 1000, 10000]):
+        res = bench(num, num_points, rng)
+        if i == 0:
+            print("obstacles | " + " | ".join(res.keys()) + "  [ms]")
+        print(
+            "{:>9} | ".format(num)
+            + " | ".join("{:>8.2f}".format(t * 1000) for t in res.values())
+        )
@@ -0,0 +1,324 @@
+# %%
+import os
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import contextlib
+import tempfile as tmp
+import numpy as np
+
+CACHE_ROOT = "{}/bss-expr-cache".format(tmp.gettempdir())
+CACHE_MAX_BYTES = 4 * 1024 ** 3
+RESULT_CACHE = "{}/bss-expr-results.sqlite".format(tmp.gettempdir())
+RESULT_CACHE_MAX_ENTRIES = 1000000
+FEATURE_CACHE = "{}/bss-expr-features.sqlite".format(tmp.gettempdir())
+
+
+# %%
+def corpus_key(params):
+    id = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(id.encode("utf-8")).hexdigest()
+
+
+# %%
+@contextlib.contextmanager
+def locked(dirpath, blocking=True, shared=False):
+    """
+    Lock on a corpus directory between processes and hosts, through flock
+    on {dirpath}.lock: next to the directory, so that the lock outlives the
+    directory when it is evicted. Exclusive to build or remove a corpus,
+    shared to read it. Yields False if not blocking and the lock is held
+    (exclusively, for a shared lock).
+    """
+    with open("{}.lock".format(dirpath), mode="a") as f:
+        try:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# %%
+def atomic_write(filepath, write, mode="w"):
+    """
+    Write a file through a temporary file in the same directory and rename it,
+    so that readers never see a half-written file.
+    """
+    dirpath = os.path.dirname(filepath) or "."
+    fd, tmppath = tmp.mkstemp(dir=dirpath, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, mode=mode) as f:
+            write(f)
+        os.replace(tmppath, filepath)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+# %%
+def read_manifest(dirpath):
+    filepath = "{}/manifest.json".format(dirpath)
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, mode="r") as f:
+        return json.load(f)
+
+
+# %%
+def write_manifest(dirpath, manifest):
+    atomic_write(
+        "{}/manifest.json".format(dirpath), lambda f: json.dump(manifest, f, indent=2)
+    )
+
+
+# %%
+def file_sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, mode="rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# %%
+def is_valid_entry(dirpath, entry):
+    if entry is None:
+        return False
+    filepath = "{}/{}".format(dirpath, entry["file"])
+    return os.path.exists(filepath) and os.path.getsize(filepath) == entry["size"]
+
+
+# %%
+def corpus_size(dirpath):
+    return sum(e.stat().st_size for e in os.scandir(dirpath) if e.is_file())
+
+
+# %%
+def corpus_size_of_root(root):
+    return sum(corpus_size(e.path) for e in os.scandir(root) if e.is_dir())
+
+
+# %%
+def evict(root=CACHE_ROOT, max_bytes=CACHE_MAX_BYTES, keep=None):
+    """
+    Remove least recently used corpora until the cache fits in max_bytes.
+    Corpora being built or read (locked by another process) are skipped.
+    """
+    corpora = []
+    for e in os.scandir(root):
+        if not e.is_dir() or e.path == keep:
+            continue
+        manifest = read_manifest(e.path)
+        last_used = manifest["last used"] if manifest is not None else e.stat().st_mtime
+        corpora.append((last_used, e.path))
+    total = corpus_size_of_root(root)
+    for _, dirpath in sorted(corpora):
+        if total <= max_bytes:
+            break
+        size = corpus_size(dirpath)
+        with locked(dirpath, blocking=False) as ok:
+            if not ok:
+                continue
+            shutil.rmtree(dirpath)
+        total -= size
+
+
+# %%
+@contextlib.contextmanager
+def cached_corpus(
+    params,
+    num,
+    build,
+    entropy=None,
+    version=None,
+    root=CACHE_ROOT,
+    max_bytes=CACHE_MAX_BYTES,
+    suffix=".json",
+):
+    """
+    Yields paths of num instance files generated from params, generating
+    only the ones missing from the cache. The corpus holds a shared lock
+    until the block is over, so that it is not evicted while in use.
+
+    with cached_corpus(params, num, build) as filepaths:
+        ...
+
+    build(tasks) writes the files, where tasks is a list of
+    (filepath, SeedSequence). Instance i is drawn from
+    SeedSequence(entropy, spawn_key=(i,)), i.e. the i-th child of
+    SeedSequence(entropy).spawn(), so corpora of different sizes share
+    their first instances. If entropy is None, fresh entropy is drawn once
+    and recorded in the manifest.
+
+    The corpus directory is keyed by params and version, the manifest
+    records the seed, generator version, size and sha256 of every file.
+    """
+    os.makedirs(root, exist_ok=True)
+    key = dict(params, **{"generator version": version, "entropy": entropy})
+    dirpath = "{}/{}".format(root, corpus_key(key))
+
+    # Complete corpora are only read, under a shared lock. Others are built
+    # under an exclusive lock, and checked again under the shared one since
+    # they may be evicted in between.
+    while True:
+        with locked(dirpath, shared=True):
+            manifest = read_manifest(dirpath)
+            entries = manifest["files"] if manifest is not None else {}
+            complete = manifest is not None and all(
+                is_valid_entry(dirpath, entries.get(str(i))) for i in range(num)
+            )
+            if complete:
+                # Readers never change the files, only when they were last used
+                manifest["last used"] = time.time()
+                write_manifest(dirpath, manifest)
+                yield [
+                    "{}/{}".format(dirpath, entries[str(i)]["file"]) for i in range(num)
+                ]
+                return
+        build_corpus(dirpath, params, num, build, entropy, version, suffix)
+        evict(root, max_bytes, keep=dirpath)
+
+
+# %%
+def build_corpus(dirpath, params, num, build, entropy, version, suffix):
+    with locked(dirpath):
+        os.makedirs(dirpath, exist_ok=True)
+        manifest = read_manifest(dirpath)
+        if manifest is None:
+            if entropy is None:
+                entropy = np.random.SeedSequence().entropy
+            manifest = {
+                "params": params,
+                "generator version": version,
+                "entropy": entropy,
+                "files": {},
+            }
+
+        entries = manifest["files"]
+        missing = [
+            i for i in range(num) if not is_valid_entry(dirpath, entries.get(str(i)))
+        ]
+        if len(missing) > 0:
+            tasks = [
+                (
+                    "{}/.tmp-pbm-{}{}".format(dirpath, i, suffix),
+                    np.random.SeedSequence(manifest["entropy"], spawn_key=(i,)),
+                )
+                for i in missing
+            ]
+            build(tasks)
+            for i, (tmppath, _) in zip(missing, tasks):
+                filename = "pbm-{}{}".format(i, suffix)
+                os.replace(tmppath, "{}/{}".format(dirpath, filename))
+                entries[str(i)] = {
+                    "file": filename,
+                    "seed": {"entropy": manifest["entropy"], "spawn key": [i]},
+                    "generator version": version,
+                    "size": os.path.getsize("{}/{}".format(dirpath, filename)),
+                    "sha256": file_sha256("{}/{}".format(dirpath, filename)),
+                }
+
+        manifest["last used"] = time.time()
+        write_manifest(dirpath, manifest)
+
+
+# %%
+binary_hashes = {}
+
+
+# %%
+def binary_hash(filepath):
+    """
+    sha256 of a solver binary, computed again only once the file changes.
+    """
+    st = os.stat(filepath)
+    key = (os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+    if key not in binary_hashes:
+        binary_hashes[key] = file_sha256(filepath)
+    return binary_hashes[key]
+
+
+# %%
+def result_key(instance_hash, command_line, binary):
+    """
+    Key of a simulation result: instance content, solver command line
+    (without file paths) and solver binary.
+    """
+    return corpus_key([instance_hash, command_line, binary])
+
+
+# %%
+def open_result_cache(path=RESULT_CACHE):
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        " key TEXT PRIMARY KEY, binary TEXT, record TEXT, last_used REAL)"
+    )
+    return conn
+
+
+# %%
+def lookup_result(key, path=RESULT_CACHE):
+    conn = open_result_cache(path)
+    try:
+        row = conn.execute(
+            "SELECT record FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        return json.loads(row[0])
+    finally:
+        conn.close()
+
+
+# %%
+def store_result(
+    key, binary, record, path=RESULT_CACHE, max_entries=RESULT_CACHE_MAX_ENTRIES
+):
+    """
+    Store a result, evicting the least recently used ones beyond max_entries.
+    """
+    conn = open_result_cache(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            (key, binary, json.dumps(record), time.time()),
+        )
+        conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results"
+            " ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (max_entries,),
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+# %%
+def invalidate_results(keep_binary=None, path=RESULT_CACHE):
+    """
+    Remove the results of every solver binary but keep_binary (a hash from
+    binary_hash), e.g. once the solver is rebuilt; all results if None.
+    """
+    conn = open_result_cache(path)
+    try:
+        if keep_binary is None:
+            conn.execute("DELETE FROM results")
+        else:
+            conn.execute("DELETE FROM results WHERE binary != ?", (keep_binary,))
+    finally:
+        conn.close()
@@ -2,12 +2,41 @@
 import os
 import sys
 import json
-import subprocess
 import datetime
 import numpy as np
+import timing
 import hashlib
+import inspect
+import contextlib
 import tempfile as tmp
-import shutil
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
+from cache import (
+    cached_corpus,
+    corpus_key,
+    lookup_result,
+    store_result,
+    FEATURE_CACHE,
+)
+from instance import (
+    new_instance,
+    save_instance,
+    load_instance,
+    export_bss_json,
+    import_bss_json,
+    content_hash,
+)
+from runner import (
+    retry_policy,
+    new_straggler_timeout,
+    min_timeout,
+    run_jobs,
+    new_throughput,
+    append_run_index,
+    compress_file,
+    run_bss,
+    COMPRESSIONS,
+)
 
 
 # %%
@@ -23,31 +52,299 @@ def rect_point_collision(rect, point):
 
 
 # %%
-def estimate_area_of_collision_space(xrange, yrange, precision, collision_free):
+def polys_point_collision(polys, points):
     """
-    r = 20.0
-    c = np.array([50, 50])
-    xrange = (0, 100)
-    yrange = xrange
-    is_free = lambda p: np.linalg.norm(c - p) > r
-    area = estimate_area_of_collision_space(xrange, yrange, 16.0, is_free)
+    Vectorized version of rect_point_collision for convex polygons.
+    polys: (M, V, 2), points: (K, 2) -> (K, M) bool
     """
-    assert precision > 0.0
-    assert xrange[1] > xrange[0]
-    assert yrange[1] > yrange[0]
-    xmin, xmax = xrange
-    ymin, ymax = yrange
-    xsize = xmax - xmin
-    ysize = ymax - ymin
-    pmin = np.array([xmin, ymin])
-    pmax = np.array([xmax, ymax])
-    n = round(xsize * ysize * precision ** 2)
+    assert polys.ndim == 3 and polys.shape[2] == 2
+    assert points.ndim == 2 and points.shape[1] == 2
+    o = np.roll(polys, 1, axis=1)
+    e = polys - o
+    d = points[:, None, None, :] - o[None]
+    test = e[None, :, :, 0] * d[..., 1] - e[None, :, :, 1] * d[..., 0]
+    return np.all(test >= 0.0, axis=2) | np.all(test <= 0.0, axis=2)
+
+
+# %%
+def polys_rect_collision(polys, rect):
+    """
+    Separating axis test of a convex polygon against each of convex polygons.
+    polys: (M, V, 2), rect: (W, 2) -> (M,) bool
+    """
+    rects = np.broadcast_to(rect, (len(polys),) + rect.shape)
+    edges = np.concatenate(
+        [polys - np.roll(polys, 1, axis=1), rects - np.roll(rects, 1, axis=1)], axis=1
+    )
+    axes = np.stack([-edges[..., 1], edges[..., 0]], axis=2)
+    p = np.einsum("mvd,mad->mav", polys, axes)
+    r = np.einsum("mwd,mad->maw", rects, axes)
+    separated = (p.max(axis=2) < r.min(axis=2)) | (r.max(axis=2) < p.min(axis=2))
+    return ~separated.any(axis=1)
+
+
+# %%
+def new_obstacle_index(obstacles, cell_size=None):
+    """
+    Uniform grid over the bounding boxes of convex obstacles, so that
+    queries only test the obstacles sharing a cell with the query.
+
+    point_collision, rect_collision = new_obstacle_index(obstacles, 40.0)
+    point_collision(points)  # (K, 2) -> (K,) bool
+    rect_collision(rect)  # (V, 2) -> bool
+    """
+    polys = np.array(obstacles, dtype=float).reshape(-1, 4, 2)
+    lo = polys.min(axis=1)
+    hi = polys.max(axis=1)
+    if cell_size is None:
+        cell_size = (hi - lo).mean() if len(polys) > 0 else 1.0
+    assert cell_size > 0.0
+    origin = lo.min(axis=0) if len(polys) > 0 else np.zeros(2)
+    ilo = np.floor((lo - origin) / cell_size).astype(int)
+    ihi = np.floor((hi - origin) / cell_size).astype(int)
+    ny = ihi[:, 1].max() + 1 if len(polys) > 0 else 1
+
+    buckets = {}
+    for i, ((x0, y0), (x1, y1)) in enumerate(zip(ilo, ihi)):
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                buckets.setdefault(cx * ny + cy, []).append(i)
+    buckets = {k: np.array(v) for k, v in buckets.items()}
+
+    def cells_of(points):
+        c = np.floor((points - origin) / cell_size).astype(int)
+        inside = (c >= 0).all(axis=1) & (c[:, 1] < ny)
+        return np.where(inside, c[:, 0] * ny + c[:, 1], -1)
+
+    def point_collision(points):
+        hits = np.zeros(len(points), dtype=bool)
+        keys = cells_of(points)
+        for key in np.unique(keys):
+            if key not in buckets:
+                continue
+            mask = keys == key
+            hits[mask] = polys_point_collision(
+                polys[buckets[key]], points[mask]
+            ).any(axis=1)
+        return hits
+
+    def rect_collision(rect):
+        (x0, y0), (x1, y1) = np.floor(
+            (np.array([rect.min(axis=0), rect.max(axis=0)]) - origin) / cell_size
+        ).astype(int)
+        keys = [
+            cx * ny + cy
+            for cx in range(max(x0, 0), x1 + 1)
+            for cy in range(max(y0, 0), min(y1, ny - 1) + 1)
+        ]
+        cands = [buckets[k] for k in keys if k in buckets]
+        if len(cands) == 0:
+            return False
+        cands = np.unique(np.concatenate(cands))
+        return bool(polys_rect_collision(polys[cands], rect).any())
+
+    return point_collision, rect_collision
+
+
+# %%
+def union_length_of_intervals(lo, hi):
+    """
+    Total length covered by the union of intervals on each row.
+    lo, hi: (S, M) -> (S,)
+    """
+    order = np.argsort(lo, axis=1)
+    lo = np.take_along_axis(lo, order, axis=1)
+    hi = np.take_along_axis(hi, order, axis=1)
+    prevmax = np.maximum.accumulate(hi, axis=1)
+    prevmax = np.concatenate([np.full((len(hi), 1), -np.inf), prevmax[:, :-1]], axis=1)
+    return np.maximum(0.0, hi - np.maximum(lo, prevmax)).sum(axis=1)
+
+
+# %%
+def segments_intersection_xs(a, b, owner):
+    """
+    x coordinates where segments (a -> b) of different owners cross each other.
+    a, b: (E, 2), owner: (E,)
+    """
+    r = b - a
+    xs = []
+    chunk = max(1, 2 ** 20 // max(1, len(a)))
+    for i in range(0, len(a), chunk):
+        p, rp = a[i : i + chunk, None], r[i : i + chunk, None]
+        qp = a[None] - p
+        denom = rp[..., 0] * r[None, :, 1] - rp[..., 1] * r[None, :, 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (qp[..., 0] * r[None, :, 1] - qp[..., 1] * r[None, :, 0]) / denom
+            u = (qp[..., 0] * rp[..., 1] - qp[..., 1] * rp[..., 0]) / denom
+            x = p[..., 0] + t * rp[..., 0]
+        valid = (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+        valid &= owner[i : i + chunk, None] != owner[None]
+        xs.append(x[valid])
+    return np.concatenate(xs) if len(xs) > 0 else np.empty(0)
+
+
+# %%
+def horizontal_crossing_xs(a, b, y):
+    """
+    x coordinates where segments (a -> b) cross the horizontal line at y.
+    a, b: (E, 2)
+    """
+    dy = b[:, 1] - a[:, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (y - a[:, 1]) / dy
+    valid = (dy != 0) & (t >= 0) & (t <= 1)
+    return (a[:, 0] + t * (b[:, 0] - a[:, 0]))[valid]
+
+
+# %%
+def exact_area_of_obstacles(xrange, yrange, obstacles):
+    """
+    Exact area of the union of convex obstacles clipped by the field.
+    The field is cut into vertical slabs at every vertex, edge crossing and
+    crossing of an edge with the bottom or top of the field; inside a slab
+    the covered length is linear in x, so its value at the middle of the
+    slab gives the area of the slab.
+    """
+    (xmin, xmax), (ymin, ymax) = xrange, yrange
+    polys = np.array(obstacles, dtype=float).reshape(-1, 4, 2)
+    if len(polys) == 0:
+        return 0.0
+    a = polys.reshape(-1, 2)
+    b = np.roll(polys, -1, axis=1).reshape(-1, 2)
+    owner = np.repeat(np.arange(len(polys)), polys.shape[1])
+    xs = np.concatenate(
+        [
+            [xmin, xmax],
+            a[:, 0],
+            segments_intersection_xs(a, b, owner),
+            horizontal_crossing_xs(a, b, ymin),
+            horizontal_crossing_xs(a, b, ymax),
+        ]
+    )
+    xs = np.unique(xs[(xmin <= xs) & (xs <= xmax)])
+    mids = (xs[1:] + xs[:-1]) / 2
+    widths = xs[1:] - xs[:-1]
+
+    x0, y0 = polys[..., 0], polys[..., 1]
+    x1, y1 = np.roll(x0, -1, axis=1), np.roll(y0, -1, axis=1)
+    area = 0.0
+    chunk = max(1, 2 ** 20 // polys.size)
+    for i in range(0, len(mids), chunk):
+        x = mids[i : i + chunk, None, None]
+        valid = (np.minimum(x0, x1) <= x) & (x <= np.maximum(x0, x1)) & (x0 != x1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            y = y0 + (x - x0) * (y1 - y0) / (x1 - x0)
+        lo = np.clip(np.where(valid, y, np.inf).min(axis=2), ymin, ymax)
+        hi = np.clip(np.where(valid, y, -np.inf).max(axis=2), ymin, ymax)
+        hi = np.maximum(lo, hi)
+        area += np.dot(union_length_of_intervals(lo, hi), widths[i : i + chunk])
+    return float(area)
+
+
+# %%
+def estimate_area_of_obstacles(
+    xrange,
+    yrange,
+    obstacles,
+    tolerance=0.005,
+    z=1.96,
+    chunk_size=8192,
+    min_samples=4096,
+    max_samples=2 ** 24,
+    rng=None,
+):
+    """
+    Monte Carlo estimate of the area covered by convex obstacles in the field.
+    Samples are drawn in chunks until the confidence interval of the covered
+    ratio of the field (z * standard error) is narrower than +-tolerance.
+    Returns (area, half width of the confidence interval of the area).
+    """
+    (xmin, xmax), (ymin, ymax) = xrange, yrange
+    assert xmax > xmin and ymax > ymin
+    polys = np.array(obstacles, dtype=float).reshape(-1, 4, 2)
+    size = (xmax - xmin) * (ymax - ymin)
+    if len(polys) == 0:
+        return 0.0, 0.0
+    if rng is None:
+        rng = np.random.default_rng()
+    point_collision, _ = new_obstacle_index(polys)
     hits = 0
-    for i in range(n):
-        prand = (pmax - pmin) * np.random.rand(2) + pmin
-        if not collision_free(prand):
-            hits += 1
-    return hits / n * xsize * ysize
+    n = 0
+    while True:
+        ps = rng.uniform([xmin, ymin], [xmax, ymax], (chunk_size, 2))
+        hits += point_collision(ps).sum()
+        n += chunk_size
+        # Agresti-Coull adjustment keeps the interval open at 0% and 100%
+        p = (hits + z ** 2 / 2) / (n + z ** 2)
+        half_width = z * np.sqrt(p * (1 - p) / (n + z ** 2))
+        if n >= max_samples or (n >= min_samples and half_width <= tolerance):
+            return float(hits / n * size), float(half_width * size)
+
+
+# %%
+def area_of_obstacles(xrange, yrange, obstacles, mode="exact", **kwargs):
+    """
+    mode "exact": area of the union of obstacles (exact_area_of_obstacles)
+    mode "mc": Monte Carlo estimate (estimate_area_of_obstacles)
+    """
+    if mode == "exact":
+        return exact_area_of_obstacles(xrange, yrange, obstacles)
+    if mode == "mc":
+        return estimate_area_of_obstacles(xrange, yrange, obstacles, **kwargs)[0]
+    raise ValueError("unknown mode: {}".format(mode))
+
+
+# %%
+def nearest_neighbour_distances(points, chunk=1024):
+    """
+    Distance from every point to its nearest other point (inf if alone),
+    computing the pairwise distances chunk rows at a time.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    distances = np.empty(len(points))
+    for i in range(0, len(points), chunk):
+        d = np.linalg.norm(points[i : i + chunk, None] - points[None], axis=2)
+        d[np.arange(len(d)), np.arange(i, i + len(d))] = np.inf
+        distances[i : i + chunk] = d.min(axis=1)
+    return distances
+
+
+# %%
+INSTANCE_FEATURES = [
+    "occupancy ratio",
+    "sensor density",
+    "nn distance",
+    "max nn distance",
+    "base distance",
+]
+
+
+# %%
+def instance_features(instance):
+    """
+    Features of an instance which runs may be compared by: occupancy ratio
+    of the obstacles in the field, sensor density (statics and mobiles per
+    m^2 of field), mean and max distance [m] from a sensor to its nearest
+    sensor, and largest distance [m] between base nodes. Distances are NaN
+    without two nodes to measure them.
+    """
+    xmin, ymin, xmax, ymax = instance.field
+    area = (xmax - xmin) * (ymax - ymin)
+    occupied = area_of_obstacles((xmin, xmax), (ymin, ymax), instance.obstacles)
+    sensors = np.concatenate([instance.statics, instance.mobiles])
+    nn = nearest_neighbour_distances(sensors) if len(sensors) >= 2 else [np.nan]
+    base = np.asarray(instance.base)
+    if len(base) >= 2:
+        base_distance = np.linalg.norm(base[:, None] - base[None], axis=2).max()
+    else:
+        base_distance = np.nan
+    return {
+        "occupancy ratio": float(occupied / area),
+        "sensor density": float(len(sensors) / area),
+        "nn distance": float(np.mean(nn)),
+        "max nn distance": float(np.max(nn)),
+        "base distance": float(base_distance),
+    }
 
 
 # %%
@@ -65,50 +362,96 @@ def new_rect(center, width, height, angle):
 
 
 # %%
-def random_rects(xrange, yrange, width, height, num, collision_free):
+def new_rects(centers, width, height, angles):
+    """
+    Vectorized new_rect.
+    centers: (N, 2), angles: (N,) -> (N, 4, 2)
+    """
+    assert np.all((-180 <= angles) & (angles <= 180))
+    t = np.pi * np.asarray(angles)[:, None] / 180.0
+    vx = np.array([-width / 2, -width / 2, width / 2, width / 2])
+    vy = np.array([-height / 2, height / 2, height / 2, -height / 2])
+    x = np.cos(t) * vx - np.sin(t) * vy + centers[:, 0:1]
+    y = np.sin(t) * vx + np.cos(t) * vy + centers[:, 1:2]
+    return np.stack([x, y], axis=2)
+
+
+# %%
+def random_rects_batch(
+    xrange, yrange, width, height, num, collision_free, batch_size=64, rng=None
+):
+    """
+    num rotated rectangles placed uniformly at random, drawn in blocks from
+    which the ones which are not collision free are rejected.
+    collision_free: (N, 4, 2) -> (N,) bool
+    """
+    if rng is None:
+        rng = np.random.default_rng()
     xmin, xmax = xrange
     ymin, ymax = yrange
-    pmin = np.array([xmin, ymin])
-    pmax = np.array([xmax, ymax])
     rotmin, rotmax = -180, 180
-    rects = []
+    rects = np.empty((0, 4, 2))
     while len(rects) < num:
-        center = (pmax - pmin) * np.random.rand(2) + pmin
-        rot = (rotmax - rotmin) * np.random.rand() + rotmin
-        rect = new_rect(center, width, height, rot)
-        if collision_free(rect):
-            rects.append(rect)
-    return rects
+        centers = rng.uniform([xmin, ymin], [xmax, ymax], (batch_size, 2))
+        rots = rng.uniform(rotmin, rotmax, batch_size)
+        cands = new_rects(centers, width, height, rots)
+        rects = np.concatenate([rects, cands[collision_free(cands)]])
+    return rects[:num]
 
 
 # %%
-def random_points(num, collision_free, generate_point):
-    points = []
-    rng = np.random.default_rng()
-    while len(points) < num:
-        prand = generate_point(rng)
-        if collision_free(prand):
-            points.append(prand)
-    return points
+def truncated_normal(rng, mean, std, low, high, n):
+    """
+    Normal samples restricted to [low, high], drawn in blocks from which
+    the samples out of range are rejected. Blocks are sized by the share of
+    samples in range, so that one block is usually enough.
+    """
+    dist = NormalDist(mean, std)
+    accepted = dist.cdf(high) - dist.cdf(low)
+    samples = np.empty(0)
+    while len(samples) < n:
+        missing = n - len(samples)
+        block = rng.normal(mean, std, int(1.1 * missing / accepted) + 16)
+        samples = np.concatenate([samples, block[(low <= block) & (block <= high)]])
+    return samples[:n]
 
 
 # %%
-def new_counter(initial):
-    next_value = initial
-
-    def counter():
-        nonlocal next_value
-        ret = next_value
-        next_value += 1
-        return ret
-
-    return counter
+def random_points_batch(
+    num, collision_free, generate_points, batch_size=1024, rng=None
+):
+    """
+    num points drawn by generate_points, rejecting the ones which are not
+    collision free. Candidates are drawn in blocks and accepted in order,
+    so the result follows the distribution of drawing them one at a time.
+    collision_free: (K, 2) -> (K,) bool, generate_points: (rng, K) -> (K, 2)
+    """
+    points = np.empty((0, 2))
+    if rng is None:
+        rng = np.random.default_rng()
+    while len(points) < num:
+        prand = generate_points(rng, batch_size)
+        points = np.concatenate([points, prand[collision_free(prand)]])
+    return points[:num]
 
 
 # %%
-def new_problem_instance(
-    field_size, size_obstacle, num_static, num_mobile, num_obstacle
+def new_problem_arrays(
+    field_size,
+    size_obstacle,
+    num_static,
+    num_mobile,
+    num_obstacle,
+    cell_size=None,
+    rng=None,
 ):
+    """
+    cell_size: if given, sensor placement tests obstacles through a grid
+    index with the cell size instead of scanning all of them.
+    rng: np.random.Generator to draw the instance from.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
 
     (field_width, field_height) = field_size
     xrange = (-field_width / 2, field_width / 2)
@@ -117,63 +460,79 @@ def new_problem_instance(
     (ymin, ymax) = yrange
     ymid = (ymin + ymax) / 2
 
-    base_nodes = [
-        np.array([xmin, ymid]),
-        np.array([xmax, ymid]),
-    ]
+    base_nodes = np.array(
+        [
+            [xmin, ymid],
+            [xmax, ymid],
+        ]
+    )
 
-    collision_free = lambda r: all([not rect_point_collision(r, p) for p in base_nodes])
+    collision_free = lambda rs: ~polys_point_collision(rs, base_nodes).any(axis=0)
 
-    obstacles = random_rects(
-        xrange, yrange, size_obstacle[0], size_obstacle[1], num_obstacle, collision_free
+    obstacles = random_rects_batch(
+        xrange,
+        yrange,
+        size_obstacle[0],
+        size_obstacle[1],
+        num_obstacle,
+        collision_free,
+        rng=rng,
     )
 
-    collision_free = lambda p: all([not rect_point_collision(o, p) for o in obstacles])
+    if cell_size is None:
+        collision_free = lambda ps: ~polys_point_collision(obstacles, ps).any(axis=1)
+    else:
+        point_collision, _ = new_obstacle_index(obstacles, cell_size)
+        collision_free = lambda ps: ~point_collision(ps)
 
-    z = 3.29  # 99.9% of generated points are in a range (ymin ,ymax)
-    generate_point = lambda rng: np.array(
+    z = 3.29  # 99.9% of the untruncated normal is in a range (ymin ,ymax)
+    generate_points = lambda rng, n: np.column_stack(
         [
-            rng.uniform(xmin, xmax),
-            rng.normal(ymid, (ymax - ymin) / 2 / z),
+            rng.uniform(xmin, xmax, n),
+            truncated_normal(rng, ymid, (ymax - ymin) / 2 / z, ymin, ymax, n),
         ]
     )
 
-    static_nodes = random_points(num_static, collision_free, generate_point)
-    mobile_nodes = random_points(num_mobile, collision_free, generate_point)
-
-    next_id = new_counter(initial=0)
+    static_nodes = random_points_batch(
+        num_static, collision_free, generate_points, rng=rng
+    )
+    mobile_nodes = random_points_batch(
+        num_mobile, collision_free, generate_points, rng=rng
+    )
 
-    return {
-        "field": [xmin, ymin, xmax, ymax],
-        "obstacles": [
-            {
-                "kind": "Hollow",
-                "shape": shape.tolist(),
-            }
-            for shape in obstacles
-        ],
-        "base_nodes": {str(next_id()): {"x": p[0], "y": p[1]} for p in base_nodes},
-        "static_sensor_nodes": {
-            str(next_id()): {"x": p[0], "y": p[1], "battery": 0.0, "mode": "Sleep"}
-            for p in static_nodes
-        },
-        "mobile_sensor_nodes": {
-            str(next_id()): {"x": p[0], "y": p[1], "battery": 0.0, "mode": "Sleep"}
-            for p in mobile_nodes
-        },
-    }
+    return new_instance(
+        [xmin, ymin, xmax, ymax], base_nodes, static_nodes, mobile_nodes, obstacles
+    )
 
 
 # %%
 def make_problem_file(
-    filepath, field_size, size_obstacle, num_static, num_mobile, num_obstacle
+    filepath,
+    field_size,
+    size_obstacle,
+    num_static,
+    num_mobile,
+    num_obstacle,
+    seed=None,
 ):
-    instance = new_problem_instance(
-        field_size, size_obstacle, num_static, num_mobile, num_obstacle
+    """
+    seed: anything np.random.default_rng accepts, e.g. a SeedSequence
+    The instance is written as .npz (see instance.save_instance) if filepath
+    ends with .npz and as JSON for bss otherwise.
+    """
+    instance = new_problem_arrays(
+        field_size,
+        size_obstacle,
+        num_static,
+        num_mobile,
+        num_obstacle,
+        rng=np.random.default_rng(seed),
     )
 
-    with open(filepath, mode="w+") as f:
-        json.dump(instance, fp=f)
+    if filepath.endswith(".npz"):
+        save_instance(filepath, instance)
+    else:
+        export_bss_json(filepath, instance)
 
 
 # %%
@@ -195,27 +554,89 @@ def read_protocol_file(filepath):
     assert "outdir" in config
     assert "trials" in config
     assert "verbose" in config
+    if "seed" in config:
+        assert config["seed"] is None or isinstance(config["seed"], int)
+    if "workers" in config:
+        assert config["workers"] >= 1
+    if "stream" in config:
+        assert isinstance(config["stream"], bool)
+    if "retries" in config:
+        assert config["retries"] >= 0
+    if "compress" in config:
+        assert config["compress"] is None or config["compress"] in COMPRESSIONS
     return protocol
 
 
 # %%
 def make_problem_files(
-    num, field_size, size_obstacle, num_static, num_mobile, num_obstacle
+    num,
+    field_size,
+    size_obstacle,
+    num_static,
+    num_mobile,
+    num_obstacle,
+    seed=None,
+    workers=1,
 ):
-    id = "{},{},{},{},{},{}".format(
-        num, field_size, size_obstacle, num_static, num_mobile, num_obstacle
-    )
+    """
+    Instance i is drawn from the i-th child of SeedSequence(seed), so that
+    the files only depend on the seed, not on the number of workers.
+    Instances are cached (see cache.cached_corpus) and shared between calls
+    with the same parameters and seed, whatever num is. A context manager
+    yielding the paths of the files, which are kept while it is open.
+    """
+    params = {
+        "field size": list(field_size),
+        "obstacle size": list(size_obstacle),
+        "num statics": num_static,
+        "num mobiles": num_mobile,
+        "num obstacles": num_obstacle,
+    }
+
+    def build(tasks):
+        n = len(tasks)
+        args = (
+            [filepath for filepath, _ in tasks],
+            [field_size] * n,
+            [size_obstacle] * n,
+            [num_static] * n,
+            [num_mobile] * n,
+            [num_obstacle] * n,
+            [seed for _, seed in tasks],
+        )
+        if workers == 1:
+            # In this process, which also lets timing profile the generation
+            list(map(make_problem_file, *args))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(make_problem_file, *args))
 
-    dirname = hashlib.sha256(id.encode("utf-8")).hexdigest()
-    dirpath = "{}/{}".format(tmp.gettempdir(), dirname)
+    return cached_corpus(params, num, build, entropy=seed, version=GENERATOR_VERSION)
 
-    if os.path.exists(dirpath) and len(os.listdir(dirpath)) < num:
-        shutil.rmtree(dirpath)
 
-    if not os.path.exists(dirpath):
-        os.mkdir(dirpath)
-        for i in range(num):
-            filepath = "{}/pbm-{}.json".format(dirpath, i)
+# %%
+SHM_DIR = "/dev/shm"
+
+
+# %%
+def stream_problem_files(
+    dirpath,
+    num,
+    field_size,
+    size_obstacle,
+    num_static,
+    num_mobile,
+    num_obstacle,
+    seed=None,
+):
+    """
+    Yields paths of instance files generated into dirpath one at a time, as
+    they are requested. The caller removes each file once it is done with it.
+    The instances are the same as the ones of make_problem_files.
+    """
+    for i, s in enumerate(np.random.SeedSequence(seed).spawn(num)):
+        filepath = "{}/pbm-{}.json".format(dirpath, i)
+        with timing.stage("generate"), timing.profiled():
             make_problem_file(
                 filepath,
                 field_size,
@@ -223,29 +644,115 @@ def make_problem_files(
                 num_static,
                 num_mobile,
                 num_obstacle,
+                seed=s,
             )
+        yield filepath
 
-    return ["{}/{}".format(dirpath, filename) for filename in os.listdir(dirpath)]
+
+# %%
+def ram_tempdir():
+    """
+    Temporary directory in RAM (SHM_DIR) if available, removed on exit.
+    """
+    return tmp.TemporaryDirectory(
+        prefix="bss-expr-", dir=SHM_DIR if os.path.isdir(SHM_DIR) else None
+    )
 
 
 # %%
-def run_expr(command, infile, outfile, logfile=None):
-    CMD = "../../border_security_system/target/release/bss"
+# Changes whenever the code generating instances changes, so that cached
+# instances of an older generator are not reused.
+GENERATOR_VERSION = hashlib.sha256(
+    "".join(
+        inspect.getsource(f)
+        for f in [
+            polys_point_collision,
+            new_obstacle_index,
+            new_rects,
+            random_rects_batch,
+            truncated_normal,
+            random_points_batch,
+            new_problem_arrays,
+            make_problem_file,
+        ]
+    ).encode("utf-8")
+).hexdigest()[:16]
 
-    if logfile is not None:
-        cmd = "{} {} -i {} -o {} -l {} --quiet".format(
-            CMD, command, infile, outfile, logfile
-        )
-    else:
-        cmd = "{} {} -i {} -o {} --quiet".format(CMD, command, infile, outfile)
 
-    res = subprocess.call(cmd, shell=True)
-    if res != 0:
-        return None
+# %%
+# Changes whenever the code computing instance features changes
+FEATURES_VERSION = hashlib.sha256(
+    "".join(
+        inspect.getsource(f)
+        for f in [
+            segments_intersection_xs,
+            union_length_of_intervals,
+            exact_area_of_obstacles,
+            area_of_obstacles,
+            nearest_neighbour_distances,
+            instance_features,
+        ]
+    ).encode("utf-8")
+).hexdigest()[:16]
+
+
+# %%
+def cached_instance_features(instance, instance_hash=None):
+    """
+    instance_features of an instance with the "features version", from the
+    feature cache if there, keyed by instance.content_hash so that the
+    instance of a run and the one in its snapshot share their entry. With
+    the instance_hash of its file (see runner.instance_hash), they are also
+    stored for cached_file_features.
+    """
+    key = corpus_key([content_hash(instance), FEATURES_VERSION])
+    with timing.stage("feature cache"):
+        features = lookup_result(key, FEATURE_CACHE)
+    if features is None:
+        with timing.stage("features"):
+            features = instance_features(instance)
+        features["features version"] = FEATURES_VERSION
+        with timing.stage("feature cache"):
+            store_result(key, FEATURES_VERSION, features, FEATURE_CACHE)
+    if instance_hash is not None:
+        with timing.stage("feature cache"):
+            store_result(
+                file_features_key(instance_hash),
+                FEATURES_VERSION,
+                features,
+                FEATURE_CACHE,
+            )
+    return features
+
+
+# %%
+def file_features_key(instance_hash):
+    return corpus_key(["file", instance_hash, FEATURES_VERSION])
+
+
+# %%
+def cached_file_features(instance_hash):
+    """
+    Features stored by cached_instance_features for the instance file of
+    this sha256, e.g. the "instance hash" of a run index record, or None.
+    """
+    with timing.stage("feature cache"):
+        return lookup_result(file_features_key(instance_hash), FEATURE_CACHE)
+
 
-    with open(outfile, mode="r") as f:
-        snapshot = json.load(f)
-        return snapshot[-1]["laptime"] / 3600
+# %%
+def read_instance_file(filepath):
+    if filepath.endswith(".npz"):
+        return load_instance(filepath)
+    return import_bss_json(filepath)
+
+
+# %%
+def run_expr(command, infile, outfile, logfile=None):
+    record = run_bss(command, infile, outfile, logfile)
+    if record["status"] != "ok":
+        return None
+    return record["uptime"] / 3600
 
 
 # %%
@@ -262,6 +769,51 @@ def live_mean():
     return update
 
 
+# %%
+def wilson_interval_width(k, n, z):
+    p = k / n
+    return (
+        2 * z / (1 + z ** 2 / n) * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2))
+    )
+
+
+# %%
+def new_stopping_rule(adaptive):
+    """
+    Sequential stopping rule of the adaptive trials mode.
+    Returns update(uptime [h]) -> True once the trials can stop, i.e. the
+    confidence intervals of the error rate [%] and of the mean uptime [h]
+    are narrower than "error rate ci" and "uptime ci", after at least
+    "min trials" trials.
+    """
+    min_trials = adaptive.get("min trials", 10)
+    err_width = adaptive.get("error rate ci", 10.0)
+    uptime_width = adaptive.get("uptime ci", np.inf)
+    z = adaptive.get("z", 1.96)
+    uptimes = []
+    n = 0
+
+    def update(uptime):
+        nonlocal n
+        n += 1
+        if uptime > 0:
+            uptimes.append(uptime)
+        if n < min_trials:
+            return False
+        errors = n - len(uptimes)
+        if wilson_interval_width(errors, n, z) * 100 > err_width:
+            return False
+        if len(uptimes) == 0:
+            # Nothing but errors, there is no uptime to estimate
+            return True
+        if len(uptimes) < 2:
+            return False
+        width = 2 * z * np.std(uptimes, ddof=1) / np.sqrt(len(uptimes))
+        return width <= uptime_width
+
+    return update
+
+
 # %%
 def experiment(protocol):
     variables = protocol["variables"]
@@ -275,6 +827,24 @@ def experiment(protocol):
     outdir = config["outdir"]
     command = config["command"]
     verbose = config["verbose"]
+    seed = config.get("seed")
+    workers = config.get("workers", 1)
+    stream = config.get("stream", False)
+    keep_snapshots = config.get("keep snapshots", True)
+    adaptive = config.get("adaptive")
+    use_cache = config.get("result cache", False)
+    sample_interval = config.get("sample rss")
+    compression = config.get("compress")
+    policy = retry_policy(config)
+    if "straggler factor" in config:
+        update_straggler_timeout = new_straggler_timeout(config["straggler factor"])
+    if config.get("timing", False):
+        timing.enable(profile=config.get("profile generation", False))
+    else:
+        timing.disable()
+    if adaptive is not None:
+        trials = adaptive.get("max trials", trials)
+        update_stopping_rule = new_stopping_rule(adaptive)
 
     if os.path.exists(outdir):
         print("[ERROR] {} is already exists".format(outdir))
@@ -282,17 +852,41 @@ def experiment(protocol):
 
     os.mkdir(outdir)
 
-    pbmfiles = make_problem_files(
-        trials, field_size, obstacle_size, num_statics, num_mobiles, num_obstacles
-    )
+    # Holds the instances until the trials are over
+    pbmdir = contextlib.ExitStack()
+    if stream:
+        pbmfiles = stream_problem_files(
+            pbmdir.enter_context(ram_tempdir()),
+            trials,
+            field_size,
+            obstacle_size,
+            num_statics,
+            num_mobiles,
+            num_obstacles,
+            seed=seed,
+        )
+    else:
+        with timing.stage("generate"), timing.profiled():
+            pbmfiles = pbmdir.enter_context(
+                make_problem_files(
+                    trials,
+                    field_size,
+                    obstacle_size,
+                    num_statics,
+                    num_mobiles,
+                    num_obstacles,
+                    seed=seed,
+                    workers=workers,
+                )
+            )
 
     update_uptime_mean = live_mean()
     update_err_mean = live_mean()
     mean_uptime = 0
     err_rate = 0
 
-    started_at = datetime.datetime.now()
-    for i, infile in enumerate(pbmfiles):
+    def run(job):
+        i, infile = job
         outfile = "{}/snapshot-{}.json".format(outdir, i)
 
         if verbose:
@@ -300,32 +894,122 @@ def experiment(protocol):
         else:
             logfile = None
 
+        run_policy = policy
+        if "straggler factor" in config:
+            timeout = min_timeout(policy["timeout"], update_straggler_timeout())
+            run_policy = dict(policy, timeout=timeout)
+
         round_started_at = datetime.datetime.now()
-        uptime = run_expr(command, infile, outfile, logfile)
+        record = run_bss(
+            command, infile, outfile, logfile, use_cache, sample_interval, run_policy
+        )
         round_ended_at = datetime.datetime.now()
-
-        if uptime is None:
-            print("Something went wrong...")
-            exit(1)
-
-        if uptime > 0:
-            mean_uptime = update_uptime_mean(uptime)
-        err_rate = update_err_mean(int(uptime == 0)) * 100
-
-        laptime = round_ended_at - round_started_at
-        acc_laptime = round_ended_at - started_at
-
-        print(
-            "[#{}/{}] [{}] [+{}] uptime: {:.1f} [h], uptime(mean): {:.1f} [h], error-rate: {:.1f} %".format(
-                i + 1,
-                len(pbmfiles),
-                acc_laptime,
-                laptime,
-                uptime,
-                mean_uptime,
-                err_rate,
+        features = cached_file_features(record["instance hash"])
+        if features is None:
+            features = cached_instance_features(
+                read_instance_file(infile), record["instance hash"]
             )
-        )
+        record.update(features)
+
+        if stream:
+            os.remove(infile)
+        if record["status"] != "ok":
+            # A snapshot left by a killed run may be incomplete
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            # bss may be killed before it writes its log
+            if (
+                logfile is not None
+                and compression is not None
+                and os.path.exists(logfile)
+            ):
+                with timing.stage("compress"):
+                    compress_file(logfile, compression)
+        elif not record.get("cached", False):
+            if not keep_snapshots:
+                os.remove(outfile)
+            else:
+                if compression is not None:
+                    with timing.stage("compress"):
+                        outfile = compress_file(outfile, compression)
+                record["snapshot"] = os.path.basename(outfile)
+            if logfile is not None and compression is not None:
+                with timing.stage("compress"):
+                    compress_file(logfile, compression)
+
+        return record, round_ended_at - round_started_at
+
+    with pbmdir:
+        update_throughput = new_throughput()
+        started_at = datetime.datetime.now()
+        jobs = enumerate(pbmfiles)
+        results = run_jobs(run, jobs, workers)
+        trials_used = 0
+        for (i, _), (record, laptime) in results:
+            round_ended_at = datetime.datetime.now()
+            throughput = update_throughput()
+
+            with timing.stage("run index"):
+                append_run_index(outdir, [record])
+            trials_used += 1
+
+            if record["status"] != "ok":
+                # Recorded in the run index, but left out of the statistics
+                print(
+                    "[#{}/{}] [{}] [+{}] {} after {} attempts".format(
+                        i + 1,
+                        trials,
+                        round_ended_at - started_at,
+                        laptime,
+                        record["status"],
+                        record["attempts"],
+                    )
+                )
+                continue
+
+            if "straggler factor" in config:
+                update_straggler_timeout(record["elapsed time"])
+            uptime = record["uptime"] / 3600
+            if uptime > 0:
+                mean_uptime = update_uptime_mean(uptime)
+            err_rate = update_err_mean(int(uptime == 0)) * 100
+
+            acc_laptime = round_ended_at - started_at
+
+            with timing.stage("print"):
+                print(
+                    "[#{}/{}] [{}] [+{}] [{:.2f} runs/s] [rss: {:.1f} MB] [cpu: {:.1f} s] uptime: {:.1f} [h], uptime(mean): {:.1f} [h], error-rate: {:.1f} %".format(
+                        i + 1,
+                        trials,
+                        acc_laptime,
+                        laptime,
+                        throughput,
+                        record["max rss [kB]"] / 1024,
+                        record["user time"] + record["system time"],
+                        uptime,
+                        mean_uptime,
+                        err_rate,
+                    )
+                )
+
+            if adaptive is not None and update_stopping_rule(uptime):
+                break
+        results.close()
+
+    config["trials used"] = trials_used
+    if trials_used < trials:
+        print("[INFO] stopped after {} trials".format(trials_used))
+        # Outputs of the runs which were still running when the trials stopped
+        for i in range(trials_used, trials):
+            for filename in ["snapshot-{}.json", "log-{}.log"]:
+                filepath = "{}/{}".format(outdir, filename.format(i))
+                for suffix in ["", *COMPRESSIONS.values()]:
+                    if os.path.exists(filepath + suffix):
+                        os.remove(filepath + suffix)
+
+    if config.get("timing", False):
+        timing.write_report("{}/timing".format(outdir))
+        timing.disable()
 
 
 # %%
@@ -347,10 +1031,53 @@ def main(protocol_file):
         "command": "single-bridge -a 0.0 -r 500",
         "outdir": "./expr1",
         "trials": 10,
-        "verbose": false
+        "verbose": false,
+        "seed": 42,
+        "workers": 4,
+        "stream": false
       }
     }
 
+    "seed" (optional) makes the generated instances reproducible and
+    "workers" (optional) is the number of processes generating them and
+    of solver runs at a time.
+    "stream" (optional) generates each instance right before its run into
+    a RAM-backed directory instead of the persistent instance cache.
+    "keep snapshots" (optional, default true): if false, snapshots are
+    removed once their summary is recorded in {outdir}/runs.jsonl.
+    "adaptive" (optional) stops the trials early once the results are
+    certain enough, e.g.
+      {"min trials": 20, "max trials": 100, "error rate ci": 10.0,
+       "uptime ci": 5.0}
+    for confidence intervals narrower than 10 % of error rate and 5 hours
+    of mean uptime. The number of trials run is stored in the config of the
+    protocol as "trials used".
+    "result cache" (optional, default false) reuses results of earlier runs
+    of the same instance, command and bss binary (see cache.lookup_result).
+    "sample rss" (optional) samples the memory of bss every given seconds
+    into {outdir}/runs.jsonl, besides its peak RSS and CPU times.
+    "timeout" and "cpu limit" (optional) [s] kill bss after that much wall
+    or CPU time; "straggler factor" (optional) once it runs that many times
+    longer than the median run so far. Failed runs are run again up to
+    "retries" times (optional, default 0), timed out ones too with "retry
+    timeouts". Runs which still fail are recorded in {outdir}/runs.jsonl
+    with their "status" and left out of the statistics.
+    "timing" (optional, default false) reports the time spent in every
+    stage of the experiment (generation, process spawn, solver, snapshot
+    parsing, ...) to {outdir}/timing.json and {outdir}/timing.txt.
+    "compress" (optional, "gzip" or "zstd") compresses each snapshot and
+    log once its run is over, into snapshot-{i}.json.gz and log-{i}.log.gz
+    (.zst for zstd, which requires zstandard). Readers such as summary.py
+    open compressed and plain files alike (see runner.open_output).
+    "profile generation" (optional, with "timing") also profiles instance
+    generation with cProfile into {outdir}/timing.prof; use "workers": 1,
+    or "stream", so that the generation runs in the profiled process.
+
+    Every run in {outdir}/runs.jsonl also has the features of its instance
+    (see instance_features), cached by instance content in
+    cache.FEATURE_CACHE;
+    summary.py adds their means to the summaries.
+
     """
     experiment(read_protocol_file(protocol_file))
 
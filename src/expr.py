@@ -1,17 +1,77 @@
 import os
-import sys
-import shutil
 import json
-import pandas as pd
 import subprocess
 import time
 import datetime
 import itertools
-
-BSS_CMD = "../../border_security_system/target/release/bss"
-
-
-def main(protocol_file):
+import argparse
+import threading
+import tempfile
+import timing
+import workqueue
+from sink import ResultSink
+from runner import (
+    solver_argv,
+    retry_policy,
+    new_straggler_timeout,
+    min_timeout,
+    run_jobs,
+    new_throughput,
+    run_bss,
+    BSS_CMD,
+)
+from planner import (
+    cost_features,
+    read_cost_history,
+    fit_cost_model,
+    prior_cost,
+    plan_jobs,
+    estimate_wall_time,
+)
+
+USAGE_COLUMNS = [
+    "max rss [kB]",
+    "user time",
+    "system time",
+    "minor faults",
+    "major faults",
+]
+# Types of the result columns, which the first rows may not tell: the uptime
+# of runs which failed or timed out is None
+RESULT_DTYPES = {
+    "uptime": "float64",
+    "elapsed millis": "float64",
+    "error": "boolean",
+    "elapsed time": "float64",
+    "max rss [kB]": "Int64",
+    "user time": "float64",
+    "system time": "float64",
+    "minor faults": "Int64",
+    "major faults": "Int64",
+    "attempts": "Int64",
+    "instance hash": object,
+}
+
+
+def main(protocol_file, resume=False):
+    """
+    resume: continue a sweep which was interrupted, skipping the runs
+    recorded in the journal ({output path}.journal) of completed runs. The
+    instances left in the working dir are reused, only missing ones made.
+
+    With "timing" in the config, the time spent in every stage of the sweep
+    is reported to {output path}.timing.json and .txt (see timing).
+
+    Runs are started longest first, as predicted from the earlier results
+    listed in "cost history" (result files of expr.py or summaries) and,
+    when resuming, from the output so far (see plan_sweep).
+
+    Runs are killed after "timeout" [s] of wall time or "cpu limit" [s] of
+    CPU time, or once they take "straggler factor" times the median time
+    of the runs of the same problem and solver args. Failed runs are run
+    again up to "retries" times (timed out ones too with "retry
+    timeouts"), then recorded with their "status" and no uptime.
+    """
     with open(protocol_file) as f:
         protocol = json.load(f)
 
@@ -22,67 +82,432 @@ def main(protocol_file):
     args_list = solvers["args"]
     working_dir = protocol["config"]["working dir"]
     output_path = protocol["config"]["output path"]
-
-    if os.path.exists(working_dir):
+    workers = protocol["config"].get("workers", 1)
+    use_cache = protocol["config"].get("result cache", False)
+    run_policy = new_run_policy(protocol["config"])
+    journal_path = "{}.journal".format(output_path)
+    if protocol["config"].get("timing", False):
+        timing.enable()
+    else:
+        timing.disable()
+
+    if os.path.exists(working_dir) and not resume:
         print(
             "Error: Specified working directory already exists: {}".format(working_dir)
         )
         exit(1)
 
-    if os.path.exists(output_path):
+    if os.path.exists(output_path) and not resume:
         print("Error: output file already exists: {}".format(output_path))
         exit(1)
 
+    if os.path.exists(journal_path) and not resume:
+        print("Error: journal already exists: {}".format(journal_path))
+        exit(1)
+
+    completed = read_journal(journal_path) if resume else set()
+
+    def on_flush(keys):
+        for key in keys:
+            append_journal(journal_path, key)
+
+    sink = ResultSink(
+        output_path,
+        flush_rows=protocol["config"].get("flush rows", 100),
+        flush_seconds=protocol["config"].get("flush seconds", 10.0),
+        on_flush=on_flush,
+        dtypes=RESULT_DTYPES,
+    )
+
     datetime_start = datetime.datetime.now()
+    update_throughput = new_throughput()
+
+    jobs = [
+        (i_pbm, trial, i_args, args)
+        for i_pbm, problem in enumerate(problems)
+        for trial in range(trials)
+        for i_args, args in enumerate(args_list)
+        if journal_key(problem, trial, args) not in completed
+    ]
+    history = protocol["config"].get("cost history", [])
+    if resume and os.path.exists(output_path):
+        history = history + [output_path]
+    jobs = plan_sweep(problems, args_list, jobs, workers, history)
+
+    # Generate problem instance files, up to the last trial left. When
+    # resuming, the instances of the interrupted sweep are kept, so that the
+    # solver args left of a trial run on the instance of the ones done.
+    os.makedirs(working_dir, exist_ok=True)
+    for i_pbm, problem in enumerate(problems):
+        num = max([trial + 1 for i, trial, _, _ in jobs if i == i_pbm], default=0)
+        if num == 0:
+            continue
+        pbm_dir = "{}/problem-{}".format(working_dir, i_pbm + 1)
+        os.makedirs(pbm_dir, exist_ok=True)
+        with timing.stage("make instances"):
+            make_missing_problem_instances(problem, pbm_dir, num)
+
+    def run(job):
+        i_pbm, trial, i_args, args = job
+        pbm_dir = "{}/problem-{}".format(working_dir, i_pbm + 1)
+        instance = "{}/instance-{}.json".format(pbm_dir, trial + 1)
+        result_file = "{}/result-{}-{}.json".format(pbm_dir, trial + 1, i_args + 1)
+        policy = run_policy((i_pbm, args))
+
+        return run_simulation(command, args, instance, result_file, use_cache, policy)
+
+    for (i_pbm, trial, i_args, args), record in run_jobs(run, jobs, workers):
+        problem = problems[i_pbm]
+        run_policy((i_pbm, args), record)
+        with timing.stage("write results"):
+            sink.write(
+                result_row(args_list, args, problem, trial, record),
+                key=journal_key(problem, trial, args),
+            )
+        with timing.stage("print"):
+            print(
+                "[{}] [problem #{}/{}] [instance #{}/{}] [solver #{}/{}] [elapsed-time: {:.1f} s] [rss: {:.1f} MB] [cpu: {:.1f} s] [{:.2f} runs/s] [uptime: {:.2f} h] {} {}".format(
+                    datetime.datetime.now() - datetime_start,
+                    i_pbm + 1,
+                    len(problems),
+                    trial + 1,
+                    trials,
+                    i_args + 1,
+                    len(args_list),
+                    record["elapsed time"],
+                    record["max rss [kB]"] / 1024,
+                    record["user time"] + record["system time"],
+                    update_throughput(),
+                    uptime_hours(record),
+                    command,
+                    args,
+                )
+            )
+
+    with timing.stage("write results"):
+        sink.close()
+    if protocol["config"].get("timing", False):
+        timing.write_report("{}.timing".format(output_path))
+        timing.disable()
+
+
+def result_row(args_list, args, problem, trial, record):
+    frame = {**args_list[args], **problem}
+    frame["trial"] = "#{}".format(trial)
+    frame["uptime"] = record["uptime"]
+    frame["elapsed millis"] = record["elapsed millis"]
+    frame["error"] = record["error"]
+    frame["elapsed time"] = record["elapsed time"]
+    for key in USAGE_COLUMNS:
+        frame[key] = record[key]
+    frame["status"] = record["status"]
+    frame["attempts"] = record["attempts"]
+    frame["instance hash"] = record["instance hash"]
+    return frame
+
+
+def exception_record(elapsed_time, attempts):
+    """
+    Record of a run which raised, e.g. on a missing instance or a result
+    which cannot be read. attempts: leases of its job so far.
+    """
+    return {
+        "uptime": None,
+        "elapsed millis": None,
+        "error": None,
+        "elapsed time": elapsed_time,
+        **{key: None for key in USAGE_COLUMNS},
+        "status": "exception",
+        "attempts": attempts,
+        "instance hash": None,
+    }
+
+
+def uptime_hours(record):
+    # Runs which failed or timed out have no uptime
+    if record["uptime"] is None:
+        return float("nan")
+    return record["uptime"] / 3600
+
+
+def new_run_policy(config):
+    """
+    Returns policy(key, record=None) -> the policy of run_simulation for a
+    run of `key` (problem and solver args): the limits and retries of the
+    config (see runner.retry_policy), with the timeout shortened to
+    "straggler factor" times the median elapsed time of the runs of the
+    same key recorded so far through policy(key, record).
+    """
+    policy = retry_policy(config)
+    factor = config.get("straggler factor")
+    stragglers = {}
+    lock = threading.Lock()
+
+    def update(key, record=None):
+        if factor is None:
+            return policy
+        key = json.dumps(key)
+        with lock:
+            if key not in stragglers:
+                stragglers[key] = new_straggler_timeout(factor)
+            if record is not None and record["status"] == "ok":
+                timeout = stragglers[key](record["elapsed time"])
+            else:
+                timeout = stragglers[key]()
+        return dict(policy, timeout=min_timeout(policy["timeout"], timeout))
+
+    return update
+
+
+def plan_sweep(problems, args_list, jobs, workers, history):
+    """
+    Order jobs, (i_pbm, trial, i_args, args), longest first by the cost
+    model of planner fitted on the result files in history, and print an
+    estimate of the wall time of the sweep.
+    """
+    if len(jobs) == 0:
+        return jobs
+    features = [
+        cost_features({**problems[job[0]], **args_list[job[-1]]}) for job in jobs
+    ]
+    predict = fit_cost_model(read_cost_history(history), features)
+    if predict is None:
+        jobs, _ = plan_jobs(jobs, [prior_cost(f) for f in features])
+        print("[plan] {} jobs, no cost history to estimate wall time".format(len(jobs)))
+        return jobs
+    jobs, costs = plan_jobs(jobs, [predict(f) for f in features])
+    print(
+        "[plan] {} jobs, {} of runs, estimated wall time: {} on {} workers".format(
+            len(jobs),
+            datetime.timedelta(seconds=round(sum(costs))),
+            datetime.timedelta(seconds=round(estimate_wall_time(costs, workers))),
+            workers,
+        )
+    )
+    return jobs
+
+
+def enqueue_sweep(protocol_file, queue_path):
+    """
+    Generate the instances of every problem under the working directory and
+    enqueue the runs of the sweep, longest first (see plan_sweep), to be
+    drained by work_sweep on any host sharing the working directory and the
+    queue file.
+    """
+    with open(protocol_file) as f:
+        protocol = json.load(f)
+
+    solvers = parse_solver(protocol["solver"])
+    problems = parse_problem(protocol["problem"])
+    trials = protocol["config"]["trials"]
+    working_dir = protocol["config"]["working dir"]
+
+    if os.path.exists(queue_path):
+        print("Error: queue file already exists: {}".format(queue_path))
+        exit(1)
+
+    if os.path.exists(working_dir):
+        print(
+            "Error: Specified working directory already exists: {}".format(working_dir)
+        )
+        exit(1)
 
+    os.mkdir(working_dir)
     for i_pbm, problem in enumerate(problems):
-        # Cleanup the working directly
-        if os.path.exists(working_dir):
-            shutil.rmtree(working_dir)
-        os.mkdir(working_dir)
-        # Generate problem instance files
-        make_problem_instances(problem, working_dir, trials)
-        for trial in range(trials):
-            instance = "{}/instance-{}.json".format(working_dir, trial + 1)
-
-            for i_args, args in enumerate(args_list):
-
-                time_start = time.time()
-                uptime = run_simulation(command, args, instance, working_dir)
-                time_end = time.time()
-
-                elapsed_time = time_end - time_start
-                frame = {**args_list[args], **problem}
-                frame["trial"] = "#{}".format(trial)
-                frame["uptime"] = uptime
-                frame["elapsed time"] = elapsed_time
-                frame = pd.DataFrame([frame.values()], columns=frame.keys())
-
-                if os.path.exists(output_path):
-                    frame.to_csv(
-                        output_path,
-                        index=False,
-                        encoding="utf-8",
-                        mode="a",
-                        header=False,
+        pbm_dir = "{}/problem-{}".format(working_dir, i_pbm + 1)
+        os.mkdir(pbm_dir)
+        make_problem_instances(problem, pbm_dir, trials)
+
+    jobs = [
+        (i_pbm, trial, i_args, args)
+        for i_pbm in range(len(problems))
+        for trial in range(trials)
+        for i_args, args in enumerate(solvers["args"])
+    ]
+    jobs = plan_sweep(
+        problems,
+        solvers["args"],
+        jobs,
+        protocol["config"].get("workers", 1),
+        protocol["config"].get("cost history", []),
+    )
+    conn = workqueue.open_queue(queue_path)
+    workqueue.enqueue(conn, [(i_pbm, trial, args) for i_pbm, trial, _, args in jobs])
+
+
+def work_sweep(protocol_file, queue_path):
+    """
+    Run jobs leased from the queue on `workers` threads until it is drained.
+    Leases are renewed while a job runs; jobs of a worker which died are
+    leased again once their lease expires. A job whose run raised is leased
+    again too, and failed with an exception row after "max attempts" leases.
+    """
+    with open(protocol_file) as f:
+        protocol = json.load(f)
+
+    solvers = parse_solver(protocol["solver"])
+    problems = parse_problem(protocol["problem"])
+    command = solvers["cmd"]
+    args_list = solvers["args"]
+    working_dir = protocol["config"]["working dir"]
+    workers = protocol["config"].get("workers", 1)
+    duration = protocol["config"].get("lease seconds", 60)
+    max_attempts = protocol["config"].get("max attempts", 3)
+    use_cache = protocol["config"].get("result cache", False)
+    run_policy = new_run_policy(protocol["config"])
+    if protocol["config"].get("timing", False):
+        timing.enable()
+    else:
+        timing.disable()
+
+    datetime_start = datetime.datetime.now()
+    update_throughput = new_throughput()
+    lock = threading.Lock()
+
+    def heartbeat(job_id, owner, done):
+        conn = workqueue.open_queue(queue_path)
+        while not done.wait(duration / 3):
+            workqueue.renew(conn, job_id, owner, duration)
+        conn.close()
+
+    def work(i_worker):
+        conn = workqueue.open_queue(queue_path)
+        owner = "{}:{}".format(workqueue.worker_name(), i_worker)
+        while True:
+            with timing.stage("queue"):
+                job = workqueue.lease(conn, owner, duration, max_attempts)
+            if job is None:
+                # Wait on jobs leased by other workers, which may die
+                if workqueue.pending_jobs(conn) == 0:
+                    break
+                time.sleep(duration / 3)
+                continue
+            job_id, i_pbm, trial, args, attempts = job
+            pbm_dir = "{}/problem-{}".format(working_dir, i_pbm + 1)
+            instance = "{}/instance-{}.json".format(pbm_dir, trial + 1)
+            result_file = "{}/result-{}-{}.json".format(
+                pbm_dir, job_id, owner.replace(":", "-")
+            )
+
+            done = threading.Event()
+            threading.Thread(target=heartbeat, args=(job_id, owner, done)).start()
+            start = time.perf_counter()
+            try:
+                record = run_simulation(
+                    command,
+                    args,
+                    instance,
+                    result_file,
+                    use_cache,
+                    run_policy((i_pbm, args)),
+                )
+            except Exception as e:
+                record = exception_record(time.perf_counter() - start, attempts)
+                row = result_row(args_list, args, problems[i_pbm], trial, record)
+                with timing.stage("queue"):
+                    if attempts >= max_attempts:
+                        workqueue.fail(conn, job_id, owner, row)
+                    else:
+                        workqueue.release(conn, job_id, owner)
+                with lock, timing.stage("print"):
+                    print(
+                        "[{}] [{}] [job #{}] [attempt {}/{}] {}: {} {} {}".format(
+                            datetime.datetime.now() - datetime_start,
+                            owner,
+                            job_id,
+                            attempts,
+                            max_attempts,
+                            type(e).__name__,
+                            e,
+                            command,
+                            args,
+                        )
                     )
-                else:
-                    frame.to_csv(output_path, index=False, encoding="utf-8", mode="w")
+                continue
+            finally:
+                done.set()
+            run_policy((i_pbm, args), record)
+
+            row = result_row(args_list, args, problems[i_pbm], trial, record)
+            with timing.stage("queue"):
+                workqueue.complete(conn, job_id, owner, row)
+            with lock, timing.stage("print"):
                 print(
-                    "[{}] [problem #{}/{}] [instance #{}/{}] [solver #{}/{}] [elapsed-time: {:.1f} s] [uptime: {:.2f} h] {} {}".format(
+                    "[{}] [{}] [job #{}] [elapsed-time: {:.1f} s] [rss: {:.1f} MB] [cpu: {:.1f} s] [{:.2f} runs/s] [uptime: {:.2f} h] {} {}".format(
                         datetime.datetime.now() - datetime_start,
-                        i_pbm + 1,
-                        len(problems),
-                        trial + 1,
-                        trials,
-                        i_args + 1,
-                        len(args_list),
-                        elapsed_time,
-                        uptime / 3600,
+                        owner,
+                        job_id,
+                        record["elapsed time"],
+                        record["max rss [kB]"] / 1024,
+                        record["user time"] + record["system time"],
+                        update_throughput(),
+                        uptime_hours(record),
                         command,
                         args,
                     )
                 )
+        conn.close()
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if protocol["config"].get("timing", False):
+        timing.write_report("{}.timing-{}".format(queue_path, workqueue.worker_name()))
+        timing.disable()
+
+
+def merge_sweep(protocol_file, queue_path):
+    """
+    Write the results in the queue to the output path, in the order of jobs.
+    """
+    with open(protocol_file) as f:
+        protocol = json.load(f)
+
+    output_path = protocol["config"]["output path"]
+    conn = workqueue.open_queue(queue_path)
+    left = workqueue.pending_jobs(conn)
+    if left > 0:
+        print("Warning: {} jobs are not completed yet".format(left))
+    failed = workqueue.failed_jobs(conn)
+    if failed > 0:
+        print("Warning: {} jobs failed".format(failed))
+    if os.path.exists(output_path):
+        print("Error: output file already exists: {}".format(output_path))
+        exit(1)
+    with ResultSink(output_path, flush_rows=10000, dtypes=RESULT_DTYPES) as sink:
+        for row in workqueue.results(conn):
+            sink.write(row)
+
+
+def journal_key(problem, trial, args):
+    key = {"problem": problem, "trial": trial, "args": args}
+    return json.dumps(key, sort_keys=True)
+
+
+def read_journal(path):
+    """
+    Keys of completed runs. A last line torn by a crash is dropped from the
+    journal, so that new keys are appended on a line of their own.
+    """
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, mode="r+") as f:
+        lines = f.read().split("\n")
+        if lines[-1] != "":
+            f.truncate(sum(len(line) + 1 for line in lines[:-1]))
+        for line in lines[:-1]:
+            completed.add(line)
+    return completed
+
+
+def append_journal(path, key):
+    with open(path, mode="a") as f:
+        f.write(key + "\n")
+        f.flush()
+        os.fsync(f.fileno())
 
 
 def make_problem_recipe(problem, path):
@@ -160,38 +585,79 @@ def make_problem_instances(problem, working_dir, num):
     recipe_file = "{}/recipe.json".format(working_dir)
     make_problem_recipe(problem, recipe_file)
 
-    make_cmd = "{} make -r {} -d {} -n {}".format(
-        BSS_CMD, recipe_file, working_dir, num
-    )
+    make_cmd = solver_argv(BSS_CMD, "make", r=recipe_file, d=working_dir, n=num)
 
-    res = subprocess.call(make_cmd, shell=True)
+    res = subprocess.call(make_cmd)
     if res != 0:
-        print("Error: %s" % make_cmd)
+        print("Error: %s" % " ".join(make_cmd))
         exit(1)
 
 
-def run_simulation(command, args, instance_file, working_dir):
-    result_file = "%s/simulation_result.json" % working_dir
+def make_missing_problem_instances(problem, working_dir, num):
+    """
+    Make the instance files 1 to num which are missing from working_dir,
+    keeping the others. bss make numbers its instances from 1, so they are
+    made in a temporary directory and only the missing ones moved in.
+    """
+    missing = [
+        i
+        for i in range(1, num + 1)
+        if not os.path.exists("{}/instance-{}.json".format(working_dir, i))
+    ]
+    if len(missing) == 0:
+        return
+    with tempfile.TemporaryDirectory(dir=working_dir, prefix=".tmp-") as tmpdir:
+        make_problem_instances(problem, tmpdir, max(missing))
+        for i in missing:
+            os.replace(
+                "{}/instance-{}.json".format(tmpdir, i),
+                "{}/instance-{}.json".format(working_dir, i),
+            )
+
+
+def run_simulation(
+    command, args, instance_file, result_file, use_cache=False, policy=None
+):
+    """
+    Returns the record of runner.run_bss for a run of solver args on an
+    instance; the result file is removed once read.
+    """
     if os.path.exists(result_file):
         os.remove(result_file)
-
-    cmd = "%s %s %s -i %s -o %s --quiet" % (
-        BSS_CMD,
-        command,
-        args,
+    record = run_bss(
+        "{} {}".format(command, args),
         instance_file,
         result_file,
+        use_cache=use_cache,
+        policy=policy,
     )
-
-    res = subprocess.call(cmd, shell=True)
-    if res != 0:
-        print("Error: %s" % cmd)
-        exit(1)
-
-    with open(result_file) as f:
-        result = json.load(f)
-        return result[-1]["laptime"]
+    if record["status"] != "ok":
+        print(
+            "Warning: {} ({} attempts): {} {} -i {}".format(
+                record["status"], record["attempts"], command, args, instance_file
+            )
+        )
+    elif os.path.exists(result_file):
+        os.remove(result_file)
+    return record
 
 
 if __name__ == "__main__":
-    main(sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("protocol")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--queue", help="SQLite work queue on a shared filesystem")
+    parser.add_argument("--enqueue", action="store_true")
+    parser.add_argument("--work", action="store_true")
+    parser.add_argument("--merge", action="store_true")
+    opts = parser.parse_args()
+
+    if opts.queue is None:
+        main(opts.protocol, resume=opts.resume)
+    else:
+        if opts.enqueue:
+            enqueue_sweep(opts.protocol, opts.queue)
+        if opts.work:
+            work_sweep(opts.protocol, opts.queue)
+        if opts.merge:
+            merge_sweep(opts.protocol, opts.queue)
@@ -0,0 +1,187 @@
+# %%
+import json
+import hashlib
+import zipfile
+import numpy as np
+
+ARRAYS = ("field", "base", "statics", "mobiles", "obstacles")
+
+
+# %%
+class ProblemInstance:
+    """
+    Problem instance held in contiguous float arrays.
+
+    field: (4,) [xmin, ymin, xmax, ymax]
+    base: (B, 2), statics: (S, 2), mobiles: (M, 2) node positions
+    obstacles: (O, 4, 2) obstacle corners
+
+    Instances returned by load_instance read each array from the file on
+    first access.
+    """
+
+    __slots__ = ARRAYS + ("_source",)
+
+    def __init__(
+        self, field=None, base=None, statics=None, mobiles=None, obstacles=None
+    ):
+        self._source = None
+        for name, value in zip(ARRAYS, [field, base, statics, mobiles, obstacles]):
+            if value is not None:
+                setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # Only called for slots which are not loaded yet
+        if name == "_source":
+            raise AttributeError(name)
+        if name in ARRAYS and self._source is not None:
+            value = self._source(name)
+            setattr(self, name, value)
+            return value
+        raise AttributeError(name)
+
+    def to_bss(self):
+        """
+        The JSON document read by `bss -i`.
+        """
+        ids = iter(range(len(self.base) + len(self.statics) + len(self.mobiles)))
+        sensor = lambda p: {"x": p[0], "y": p[1], "battery": 0.0, "mode": "Sleep"}
+        return {
+            "field": self.field.tolist(),
+            "obstacles": [
+                {
+                    "kind": "Hollow",
+                    "shape": shape,
+                }
+                for shape in self.obstacles.tolist()
+            ],
+            "base_nodes": {
+                str(next(ids)): {"x": p[0], "y": p[1]} for p in self.base.tolist()
+            },
+            "static_sensor_nodes": {
+                str(next(ids)): sensor(p) for p in self.statics.tolist()
+            },
+            "mobile_sensor_nodes": {
+                str(next(ids)): sensor(p) for p in self.mobiles.tolist()
+            },
+        }
+
+
+# %%
+def new_instance(field, base, statics, mobiles, obstacles):
+    return ProblemInstance(
+        field=np.ascontiguousarray(field, dtype=np.float64).reshape(4),
+        base=np.ascontiguousarray(base, dtype=np.float64).reshape(-1, 2),
+        statics=np.ascontiguousarray(statics, dtype=np.float64).reshape(-1, 2),
+        mobiles=np.ascontiguousarray(mobiles, dtype=np.float64).reshape(-1, 2),
+        obstacles=np.ascontiguousarray(obstacles, dtype=np.float64).reshape(-1, 4, 2),
+    )
+
+
+# %%
+def from_bss(doc):
+    """
+    Instance of a JSON document read by `bss -i`, such as the "before"
+    state of a snapshot record. Closed obstacle shapes (5 points, the last
+    one repeating the first) are reduced to their 4 corners.
+    """
+    points = lambda nodes: [[n["x"], n["y"]] for n in nodes.values()]
+    shapes = [o["shape"] for o in doc["obstacles"]]
+    return new_instance(
+        field=doc["field"],
+        base=points(doc["base_nodes"]),
+        statics=points(doc["static_sensor_nodes"]),
+        mobiles=points(doc["mobile_sensor_nodes"]),
+        obstacles=[s[:4] for s in shapes],
+    )
+
+
+# %%
+def content_hash(instance):
+    """
+    sha256 of the geometry of an instance, the same whatever the file it
+    was read from (.npz, bss input or the "before" state of a snapshot)
+    and the order of its nodes and obstacles.
+    """
+    h = hashlib.sha256()
+    for name in ARRAYS:
+        # + 0.0 turns -0.0 into 0.0
+        a = np.asarray(getattr(instance, name), dtype=np.float64) + 0.0
+        if a.ndim > 1 and len(a) > 0:
+            rows = a.reshape(len(a), -1)
+            a = a[np.lexsort(rows.T[::-1])]
+        h.update("{}{}".format(name, a.shape).encode("utf-8"))
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+
+# %%
+def save_instance(filepath, instance):
+    """
+    Uncompressed .npz, so that load_instance can memory-map its arrays.
+    """
+    with open(filepath, mode="wb") as f:
+        np.savez(f, **{name: getattr(instance, name) for name in ARRAYS})
+
+
+# %%
+def npz_memmap(filepath, name):
+    """
+    Memory-map an array stored uncompressed in an .npz file.
+    """
+    with zipfile.ZipFile(filepath) as z:
+        info = z.getinfo("{}.npy".format(name))
+        assert info.compress_type == zipfile.ZIP_STORED
+    with open(filepath, mode="rb") as f:
+        # The local file header has a fixed size of 30 bytes plus the file
+        # name and the extra field, whose lengths are at offsets 26 and 28
+        f.seek(info.header_offset + 26)
+        lengths = np.frombuffer(f.read(4), dtype="<u2")
+        f.seek(info.header_offset + 30 + int(lengths.sum()))
+        if np.lib.format.read_magic(f) == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(
+        filepath,
+        dtype=dtype,
+        mode="r",
+        offset=offset,
+        shape=shape,
+        order="F" if fortran_order else "C",
+    )
+
+
+# %%
+def load_instance(filepath, mmap=True):
+    """
+    Lazily load an instance written by save_instance; arrays are read (or
+    memory-mapped if mmap) when first accessed.
+    """
+    instance = ProblemInstance()
+    if mmap:
+        instance._source = lambda name: npz_memmap(filepath, name)
+    else:
+
+        def source(name):
+            with np.load(filepath) as npz:
+                return npz[name]
+
+        instance._source = source
+    return instance
+
+
+# %%
+def export_bss_json(filepath, instance):
+    with open(filepath, mode="w+") as f:
+        json.dump(instance.to_bss(), fp=f)
+
+
+# %%
+def import_bss_json(filepath):
+    with open(filepath, mode="r") as f:
+        return from_bss(json.load(f))
@@ -0,0 +1,114 @@
+import heapq
+import numpy as np
+from sink import read_results
+
+
+def cost_features(params):
+    """
+    Numeric parameters of a job, with "field size" split into
+    "field width" and "field height" as in the summaries.
+    """
+    features = {}
+    for key, value in params.items():
+        if key == "field size":
+            features["field width"], features["field height"] = value
+        elif isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+            features[key] = value
+    return features
+
+
+def read_cost_history(paths):
+    """
+    Earlier results as (features, seconds) rows, from result files of
+    expr.py ("elapsed time" [s] per run, in any format of sink.ResultSink)
+    or from summaries ("mean elt" [ms] per configuration).
+    """
+    history = []
+    for path in paths:
+        frame = read_results(path)
+        if "elapsed time" in frame.columns:
+            seconds = frame["elapsed time"]
+        else:
+            seconds = frame["mean elt"] / 1000
+        params = frame.drop(
+            columns=[c for c in ["elapsed time", "mean elt"] if c in frame.columns]
+        )
+        if "field size" in params.columns:
+            params["field size"] = params["field size"].map(
+                lambda s: [float(v) for v in s.strip("[]").split(",")]
+            )
+        for row, s in zip(params.to_dict(orient="records"), seconds):
+            history.append((cost_features(row), s))
+    return history
+
+
+def fit_cost_model(history, jobs_features):
+    """
+    Returns predict(features) -> expected seconds of a job, or None without
+    usable history.
+
+    Only the features common to every job and every earlier result are
+    used. Jobs with the same features as earlier results are predicted by
+    their mean; others by a least squares fit of
+      log(seconds) ~ a + sum_k b_k log(1 + feature_k)
+    over the features which vary in the history.
+    """
+    history = [(f, s) for f, s in history if s > 0]
+    if len(history) == 0:
+        return None
+    names = sorted(
+        set.intersection(
+            *[set(f) for f in jobs_features], *[set(f) for f, _ in history]
+        )
+    )
+
+    observed = {}
+    for f, s in history:
+        observed.setdefault(tuple(f[k] for k in names), []).append(s)
+    observed = {key: np.mean(s) for key, s in observed.items()}
+
+    x = np.log1p(np.array([[f[k] for k in names] for f, _ in history], dtype=float))
+    y = np.log(np.array([s for _, s in history]))
+    varying = x.std(axis=0) > 0
+    a = np.column_stack([np.ones(len(x)), x[:, varying]])
+    coef, *_ = np.linalg.lstsq(a, y, rcond=None)
+
+    def predict(features):
+        key = tuple(features[k] for k in names)
+        if key in observed:
+            return observed[key]
+        z = np.log1p(np.array([features[k] for k in names], dtype=float))
+        return float(np.exp(coef[0] + z[varying] @ coef[1:]))
+
+    return predict
+
+
+def prior_cost(features):
+    """
+    Relative cost of a job when there is no history: only ranks jobs, the
+    more nodes and obstacles, the longer.
+    """
+    cost = 1.0
+    for key in ["num statics", "num mobiles", "num obstacles"]:
+        cost *= 1 + features.get(key, 0)
+    return cost
+
+
+def plan_jobs(jobs, costs):
+    """
+    Jobs in decreasing order of cost, so that the longest ones do not end
+    up as stragglers at the end of the sweep; ties keep their order.
+    """
+    order = sorted(range(len(jobs)), key=lambda i: -costs[i])
+    return [jobs[i] for i in order], [costs[i] for i in order]
+
+
+def estimate_wall_time(costs, workers):
+    """
+    Wall time [s] of running jobs of the given costs, in that order, on
+    `workers` workers each taking the next job as soon as it is free.
+    """
+    free_at = [0.0] * workers
+    for cost in costs:
+        heapq.heappush(free_at, heapq.heappop(free_at) + cost)
+    return max(free_at)
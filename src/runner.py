@@ -0,0 +1,510 @@
+# %%
+import os
+import re
+import gzip
+import json
+import math
+import mmap
+import time
+import shlex
+import signal
+import shutil
+import hashlib
+import resource
+import threading
+import subprocess
+import collections
+import numpy as np
+import timing
+from cache import binary_hash, result_key, lookup_result, store_result
+from concurrent.futures import ThreadPoolExecutor
+
+
+# %%
+def solver_argv(cmd, *args, **options):
+    """
+    argv of a solver run without going through a shell.
+
+    solver_argv("bss", "single-bridge -r 500", i="in.json", quiet=True)
+    -> ["bss", "single-bridge", "-r", "500", "-i", "in.json", "--quiet"]
+    """
+    argv = [cmd]
+    for arg in args:
+        argv += shlex.split(arg)
+    for key, value in options.items():
+        flag = "-{}".format(key) if len(key) == 1 else "--{}".format(key)
+        if value is True:
+            argv.append(flag)
+        elif value is not None and value is not False:
+            argv += [flag, str(value)]
+    return argv
+
+
+# %%
+def read_rss_kb(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return None
+
+
+# %%
+def kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+# %%
+def run_solver(argv, sample_interval=None, timeout=None, cpu_limit=None):
+    """
+    Run a solver process and collect its resource usage through os.wait4.
+    Returns (exit code, usage), where usage has "max rss [kB]", "user time"
+    and "system time" [s], "minor faults" and "major faults". With
+    sample_interval [s], the RSS of the process is also sampled over time
+    into "rss samples" as [elapsed seconds, kB] pairs.
+
+    With a timeout [s] of wall time or a cpu_limit [s] of CPU time, the
+    solver runs in a process group of its own, which is killed once over
+    the limit. usage["status"] is "ok", "error" (non-zero exit),
+    "wall timeout" or "cpu timeout".
+    """
+    limited = timeout is not None or cpu_limit is not None
+    with timing.stage("spawn"):
+        proc = subprocess.Popen(argv, start_new_session=limited)
+    if cpu_limit is not None:
+        # The kernel sends SIGXCPU at the soft limit and SIGKILL at the hard one
+        limit = math.ceil(cpu_limit)
+        resource.prlimit(proc.pid, resource.RLIMIT_CPU, (limit, limit + 1))
+    samples = []
+    done = threading.Event()
+    timed_out = threading.Event()
+
+    def sample():
+        started_at = time.time()
+        while not done.wait(sample_interval):
+            rss = read_rss_kb(proc.pid)
+            if rss is not None:
+                samples.append([time.time() - started_at, rss])
+
+    def kill():
+        timed_out.set()
+        kill_group(proc.pid)
+
+    if sample_interval is not None:
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    with timing.stage("solver"):
+        _, status, rusage = os.wait4(proc.pid, 0)
+    done.set()
+    if timeout is not None:
+        timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if limited and proc.returncode != 0:
+        # Children of the solver which outlive it
+        kill_group(proc.pid)
+
+    usage = {
+        "max rss [kB]": rusage.ru_maxrss,
+        "user time": rusage.ru_utime,
+        "system time": rusage.ru_stime,
+        "minor faults": rusage.ru_minflt,
+        "major faults": rusage.ru_majflt,
+    }
+    if proc.returncode == 0:
+        usage["status"] = "ok"
+    elif timed_out.is_set():
+        usage["status"] = "wall timeout"
+    elif cpu_limit is not None and proc.returncode in [
+        -signal.SIGXCPU,
+        -signal.SIGKILL,
+    ]:
+        usage["status"] = "cpu timeout"
+    else:
+        usage["status"] = "error"
+    if sample_interval is not None:
+        sampler.join()
+        usage["rss samples"] = samples
+    return proc.returncode, usage
+
+
+# %%
+def run_solver_retrying(argv, retries=0, retry_timeouts=False, **limits):
+    """
+    run_solver, run again up to `retries` times while it fails, and also
+    while it times out if retry_timeouts. usage["attempts"] is the number
+    of runs.
+    """
+    for attempt in range(retries + 1):
+        code, usage = run_solver(argv, **limits)
+        if usage["status"] == "ok":
+            break
+        if usage["status"] != "error" and not retry_timeouts:
+            break
+    usage["attempts"] = attempt + 1
+    return code, usage
+
+
+# %%
+def retry_policy(config):
+    """
+    Keyword arguments of run_solver_retrying from the config of a sweep or
+    an experiment: "timeout" [s], "cpu limit" [s], "retries" and
+    "retry timeouts".
+    """
+    return {
+        "timeout": config.get("timeout"),
+        "cpu_limit": config.get("cpu limit"),
+        "retries": config.get("retries", 0),
+        "retry_timeouts": config.get("retry timeouts", False),
+    }
+
+
+# %%
+def new_straggler_timeout(factor, min_runs=10):
+    """
+    Returns update(elapsed=None) -> timeout [s] of a run: factor times the
+    median elapsed time [s] of the runs recorded so far through update, or
+    None before min_runs runs.
+    """
+    elapsed_times = []
+
+    def update(elapsed=None):
+        if elapsed is not None:
+            elapsed_times.append(elapsed)
+        if len(elapsed_times) < min_runs:
+            return None
+        return factor * float(np.median(elapsed_times))
+
+    return update
+
+
+# %%
+def min_timeout(*timeouts):
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if len(timeouts) > 0 else None
+
+
+# %%
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+SNAPSHOT_SUFFIXES = (".json", ".json.gz", ".json.zst")
+
+
+# %%
+def open_output(filepath, mode="rt"):
+    """
+    Open a plain, gzip (.gz) or zstd (.zst, requires zstandard) file.
+    """
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, mode)
+    if filepath.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            print("Error: zstd files require zstandard")
+            exit(1)
+        return zstandard.open(filepath, mode)
+    return open(filepath, mode)
+
+
+# %%
+def compress_file(filepath, compression):
+    """
+    Compress a file into {filepath}.gz or .zst as a stream, and remove it.
+    Returns the path of the compressed file.
+    """
+    outpath = filepath + COMPRESSIONS[compression]
+    dirpath, filename = os.path.split(outpath)
+    tmppath = os.path.join(dirpath, ".tmp-" + filename)
+    with open(filepath, mode="rb") as src, open_output(tmppath, mode="wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmppath, outpath)
+    os.remove(filepath)
+    return outpath
+
+
+# %%
+def run_jobs(run, jobs, workers=1, pool=ThreadPoolExecutor):
+    """
+    Runs run(job) for every job on a pool of `workers` threads (each one
+    waiting on a solver process) and yields (job, result) in the order of
+    jobs, whatever the order they finish in. Jobs are pulled lazily, at most
+    4 * workers at a time, and jobs not started yet are cancelled when the
+    generator is closed. CPU bound jobs may run on a ProcessPoolExecutor as
+    pool instead, given a picklable run.
+    """
+    window = 4 * workers
+    with pool(max_workers=workers) as executor:
+        pending = collections.deque()
+        try:
+            for job in jobs:
+                pending.append((job, executor.submit(run, job)))
+                if len(pending) >= window:
+                    job, future = pending.popleft()
+                    yield job, future.result()
+            while len(pending) > 0:
+                job, future = pending.popleft()
+                yield job, future.result()
+        finally:
+            # If the caller stops early, only wait for the jobs already running
+            for _, future in pending:
+                future.cancel()
+
+
+# %%
+def new_throughput():
+    started_at = time.time()
+    n = 0
+
+    def update():
+        nonlocal n
+        n += 1
+        return n / max(time.time() - started_at, 1e-9)
+
+    return update
+
+
+# %%
+# Strings (with escapes) and brackets of a JSON document
+JSON_TOKENS = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+JSON_COLON = re.compile(rb"\s*:\s*")
+
+
+# %%
+def read_first_value(mm, key):
+    """
+    Value of key in the first object of the JSON array in mm, or None if
+    the object has no such key; only reads the file up to the key.
+    """
+    key = json.dumps(key).encode("utf-8")
+    depth = 0
+    for m in JSON_TOKENS.finditer(mm):
+        token = m.group()
+        if token in [b"[", b"{"]:
+            depth += 1
+        elif token in [b"]", b"}"]:
+            depth -= 1
+            if depth <= 1:
+                return None
+        elif depth == 2 and token == key:
+            colon = JSON_COLON.match(mm, m.end())
+            if colon is not None:
+                start = colon.end()
+                value, _ = json.JSONDecoder().raw_decode(
+                    mm[start : start + 64].decode("utf-8", errors="ignore")
+                )
+                return value
+    raise ValueError("not a JSON array")
+
+
+# %%
+def read_first_object(mm):
+    """
+    Raw bytes of the first object of the JSON array in mm; only reads the
+    file up to the end of the object.
+    """
+    depth = 0
+    for m in JSON_TOKENS.finditer(mm):
+        token = m.group()
+        if token in [b"[", b"{"]:
+            depth += 1
+            if depth == 2:
+                start = m.start()
+        elif token in [b"]", b"}"]:
+            depth -= 1
+            if depth == 1 and token == b"}":
+                return mm[start : m.end()]
+            if depth <= 1:
+                break
+    raise ValueError("not a JSON array of objects")
+
+
+# %%
+def read_last_object(mm):
+    """
+    Last object of the JSON array in mm, scanning the file backwards from
+    its end only as far as the object starts.
+    """
+    end = mm.rfind(b"}")
+    if end < 0 or mm[end + 1 :].strip() != b"]":
+        raise ValueError("not a JSON array of objects")
+    depth = 0
+    in_string = False
+    pos = end + 1
+    window = 1 << 16
+    while pos > 0:
+        start = max(0, pos - window)
+        chunk = mm[start:pos]
+        for i in reversed([m.start() for m in re.finditer(rb'[{}"]', chunk)]):
+            c = chunk[i : i + 1]
+            if c == b'"':
+                # A quote is escaped by an odd number of backslashes
+                j = start + i
+                while j > 0 and mm[j - 1 : j] == b"\\":
+                    j -= 1
+                if (start + i - j) % 2 == 0:
+                    in_string = not in_string
+            elif in_string:
+                continue
+            elif c == b"}":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return json.loads(mm[start + i : end + 1])
+        pos = start
+        window *= 2
+    raise ValueError("unbalanced JSON")
+
+
+# %%
+def read_snapshot_ends(snapshot_file):
+    """
+    (elapsed millis of the solver, laptime of the last record) of a plain
+    snapshot, reading only the start of its first record and its last
+    record. Raises ValueError if the file does not look like a snapshot.
+    """
+    with open(snapshot_file, mode="rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            elapsed = read_first_value(mm, "elapsed_time_millis_after")
+            return elapsed, read_last_object(mm)["laptime"]
+
+
+# %%
+def read_first_record(snapshot_file):
+    """
+    Raw bytes of the first record of a snapshot, which holds the instance
+    the run starts from. Plain snapshots are only read up to its end.
+    """
+    if snapshot_file.endswith(tuple(COMPRESSIONS.values())):
+        with open_output(snapshot_file, mode="rb") as f:
+            return read_first_object(f.read())
+    with open(snapshot_file, mode="rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return read_first_object(mm)
+
+
+# %%
+def read_run_summary(snapshot_file):
+    """
+    The values of a solver snapshot which experiments look at:
+    uptime [s], elapsed millis of the solver and error (no uptime).
+    Plain snapshots are read selectively (see read_snapshot_ends), others
+    or ones the selective reader does not understand are parsed in full.
+    """
+    with timing.stage("parse snapshot"):
+        try:
+            if snapshot_file.endswith(tuple(COMPRESSIONS.values())):
+                raise ValueError("compressed")
+            elapsed, uptime = read_snapshot_ends(snapshot_file)
+        except (ValueError, KeyError, TypeError):
+            with open_output(snapshot_file) as f:
+                snapshot = json.load(f)
+            uptime = snapshot[-1]["laptime"]
+            elapsed = snapshot[0].get("elapsed_time_millis_after")
+    return {
+        "uptime": uptime,
+        "elapsed millis": elapsed,
+        "error": uptime == 0,
+    }
+
+
+# %%
+def instance_hash(instance_file):
+    h = hashlib.sha256()
+    with open(instance_file, mode="rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# %%
+BSS_CMD = "../../border_security_system/target/release/bss"
+
+
+# %%
+def run_bss(
+    command,
+    infile,
+    outfile,
+    logfile=None,
+    use_cache=False,
+    sample_interval=None,
+    policy=None,
+):
+    """
+    Run bss and return the summary record of the run (see read_run_summary)
+    with its "elapsed time" [s], the resource usage of bss (see run_solver),
+    the "instance hash" and the "command".
+    With use_cache, a result stored for the same instance, command and bss
+    binary is returned instead (marked "cached"); no snapshot or log is
+    written then.
+
+    command: command line of bss, e.g. "single-bridge -r 500"
+    policy: keyword arguments of run_solver_retrying (limits and retries).
+    If bss still fails or times out, the record has its "status" and no
+    uptime.
+    """
+    ihash = instance_hash(infile)
+    if use_cache:
+        binary = binary_hash(BSS_CMD)
+        key = result_key(ihash, command, binary)
+        with timing.stage("result cache"):
+            record = lookup_result(key)
+        # Results stored before the status of runs was recorded are run again
+        if record is not None and "status" in record:
+            record["cached"] = True
+            record["instance hash"] = ihash
+            record["command"] = command
+            return record
+
+    argv = solver_argv(BSS_CMD, command, i=infile, o=outfile, l=logfile, quiet=True)
+
+    started_at = time.time()
+    res, usage = run_solver_retrying(
+        argv, sample_interval=sample_interval, **(policy or {})
+    )
+    if res != 0:
+        record = {"uptime": None, "elapsed millis": None, "error": None}
+    else:
+        record = read_run_summary(outfile)
+    record["elapsed time"] = time.time() - started_at
+    record.update(usage)
+    record["instance hash"] = ihash
+    record["command"] = command
+    if use_cache and res == 0:
+        with timing.stage("result cache"):
+            store_result(key, binary, record)
+    return record
+
+
+# %%
+RUN_INDEX = "runs.jsonl"
+
+
+# %%
+def append_run_index(dirpath, records):
+    with open("{}/{}".format(dirpath, RUN_INDEX), mode="a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+# %%
+def read_run_index(dirpath):
+    """
+    Records of append_run_index, or None if dirpath has no index.
+    """
+    filepath = "{}/{}".format(dirpath, RUN_INDEX)
+    try:
+        with open(filepath, mode="r") as f:
+            return [json.loads(line) for line in f if line.endswith("\n")]
+    except FileNotFoundError:
+        return None
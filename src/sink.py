@@ -0,0 +1,171 @@
+import os
+import time
+import fcntl
+import sqlite3
+import numpy as np
+import pandas as pd
+
+
+class ResultSink:
+    """
+    Buffers result rows and writes them in batches, once flush_rows rows are
+    buffered or flush_seconds passed since the last flush, and on close.
+
+    The backend is chosen by the extension of path:
+      .csv                appended to a single file under an exclusive flock
+      .parquet, .feather  one part file per batch in the directory `path`
+                          (requires pyarrow)
+      .sqlite, .db        rows of the table `results`
+
+    The columns are fixed by the first row written (and by the header of an
+    existing CSV), and their types by dtypes, or else by the first value
+    which is not None (see column_dtype), so that every batch has the same
+    schema. None is written as a missing value (NULL, NaN). Any number of
+    processes may write to the same path.
+
+    on_flush(keys) is called with the keys given to write() once their rows
+    are written.
+    """
+
+    def __init__(
+        self, path, flush_rows=100, flush_seconds=10.0, on_flush=None, dtypes=None
+    ):
+        self.path = path
+        self.format = os.path.splitext(path)[1].lstrip(".")
+        assert self.format in ["csv", "parquet", "feather", "sqlite", "db"]
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.on_flush = on_flush
+        self.columns = None
+        self.dtypes = dict(dtypes or {})
+        self.rows = []
+        self.keys = []
+        self.flushed_at = time.time()
+        self.parts = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, row, key=None):
+        if self.columns is None:
+            self.columns = list(row.keys())
+        assert set(row.keys()) <= set(self.columns), "unknown columns in a row"
+        for column, value in row.items():
+            if column not in self.dtypes and value is not None:
+                self.dtypes[column] = column_dtype(value)
+        self.rows.append(row)
+        if key is not None:
+            self.keys.append(key)
+        if (
+            len(self.rows) >= self.flush_rows
+            or time.time() - self.flushed_at >= self.flush_seconds
+        ):
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = time.time()
+        if len(self.rows) == 0:
+            return
+        frame = pd.DataFrame(self.rows, columns=self.columns)
+        # Columns only holding None so far are left missing as numbers
+        frame = frame.astype({c: self.dtypes.get(c, "float64") for c in self.columns})
+        if self.format == "csv":
+            write_csv(self.path, frame)
+        elif self.format in ["parquet", "feather"]:
+            write_part(self.path, frame, self.format, self.parts)
+            self.parts += 1
+        else:
+            write_sqlite(self.path, frame)
+        keys = self.keys
+        self.rows = []
+        self.keys = []
+        if self.on_flush is not None and len(keys) > 0:
+            self.on_flush(keys)
+
+    def close(self):
+        self.flush()
+
+
+def column_dtype(value):
+    if isinstance(value, (bool, np.bool_)):
+        return "boolean"
+    if isinstance(value, (int, np.integer)):
+        return "Int64"
+    if isinstance(value, (float, np.floating)):
+        return "float64"
+    return object
+
+
+def stringify_objects(frame):
+    # Values such as the field size are lists; store them as in the CSV
+    frame = frame.copy()
+    for c in frame.columns:
+        if frame[c].dtype == object:
+            frame[c] = frame[c].where(frame[c].isna(), frame[c].astype(str))
+    return frame
+
+
+def write_csv(path, frame):
+    with open(path, mode="a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                columns = list(pd.read_csv(path, nrows=0).columns)
+                assert set(columns) == set(frame.columns), "schema mismatch"
+                frame = frame[columns]
+            frame.to_csv(f, index=False, header=f.tell() == 0)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_part(path, frame, format, i):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("Error: {} output requires pyarrow".format(format))
+        exit(1)
+
+    os.makedirs(path, exist_ok=True)
+    filepath = "{}/part-{}-{}-{:06d}.{}".format(
+        path, os.uname().nodename, os.getpid(), i, format
+    )
+    frame = stringify_objects(frame)
+    if format == "parquet":
+        frame.to_parquet(filepath, index=False)
+    else:
+        frame.to_feather(filepath)
+
+
+def write_sqlite(path, frame):
+    conn = sqlite3.connect(path, timeout=60)
+    try:
+        frame = stringify_objects(frame)
+        with conn:
+            frame.to_sql("results", conn, if_exists="append", index=False)
+    finally:
+        conn.close()
+
+
+def read_results(path):
+    """
+    Everything written to a sink, as one DataFrame.
+    """
+    format = os.path.splitext(path)[1].lstrip(".")
+    if format == "csv":
+        return pd.read_csv(path)
+    if format in ["parquet", "feather"]:
+        read = pd.read_parquet if format == "parquet" else pd.read_feather
+        parts = sorted(os.listdir(path))
+        return pd.concat(
+            [read("{}/{}".format(path, p)) for p in parts], ignore_index=True
+        )
+    conn = sqlite3.connect(path)
+    try:
+        return pd.read_sql("SELECT * FROM results", conn)
+    finally:
+        conn.close()
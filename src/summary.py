@@ -2,110 +2,358 @@
 import os
 import sys
 import json
+import sqlite3
 import pandas as pd
 import numpy as np
 from experiment import (
     read_protocol_file,
-    live_mean,
-    estimate_area_of_collision_space,
-    rect_point_collision,
+    cached_instance_features,
+    cached_file_features,
+    INSTANCE_FEATURES,
+    FEATURES_VERSION,
 )
+from instance import from_bss
+from concurrent.futures import ProcessPoolExecutor
+from runner import (
+    read_run_summary,
+    read_first_record,
+    read_run_index,
+    run_jobs,
+    RUN_INDEX,
+    SNAPSHOT_SUFFIXES,
+)
+
+
+# %%
+def missing_features():
+    return {
+        **{f: np.nan for f in INSTANCE_FEATURES},
+        "features version": FEATURES_VERSION,
+    }
+
+
+# %%
+def snapshot_features(snapshot_file):
+    """
+    Features (see experiment.instance_features) of the instance a snapshot
+    starts from, the "before" state of its first record. NaN if the
+    snapshot does not hold the instance.
+    """
+    try:
+        instance = from_bss(json.loads(read_first_record(snapshot_file))["before"])
+    except (ValueError, KeyError, TypeError):
+        return missing_features()
+    return cached_instance_features(instance)
+
+
+# %%
+def record_features(dir, record):
+    """
+    Features of the instance of a run index record: its own, the ones
+    cached for its instance file, or the ones of its snapshot.
+    """
+    if record.get("features version") == FEATURES_VERSION:
+        return record
+    features = None
+    if "instance hash" in record:
+        features = cached_file_features(record["instance hash"])
+    if features is None and "snapshot" in record:
+        snapshot_file = "{}/{}".format(dir, record["snapshot"])
+        if os.path.exists(snapshot_file):
+            features = snapshot_features(snapshot_file)
+    return dict(record, **(features or missing_features()))
+
+
+# %%
+VARIABLES = [
+    "field width",
+    "field height",
+    "obstacle width",
+    "obstacle height",
+    "num mobiles",
+    "num statics",
+    "num obstacles",
+]
 
 
 # %%
-def occupancy_ratio_of_obstacles(snapshot):
-    snapshot = snapshot[0]["before"]
-    obstacles = [np.array(o["shape"][:-1]) for o in snapshot["obstacles"]]
-    print("obs.shape", obstacles[0].shape)
-    xrange = (snapshot["field"][0], snapshot["field"][2])
-    yrange = (snapshot["field"][1], snapshot["field"][3])
-    xsize = xrange[1] - xrange[0]
-    ysize = yrange[1] - yrange[0]
+TRIAL_COLUMNS = VARIABLES + [
+    "tag",
+    "dir",
+    "command",
+    "trial",
+    "status",
+    "uptime",
+    "elt",
+    "error",
+    *INSTANCE_FEATURES,
+]
 
-    def collision_free(p):
-        all([not rect_point_collision(r, p) for r in obstacles])
 
-    area = estimate_area_of_collision_space(xrange, yrange, 1.0, collision_free)
-    return area / (xsize * ysize)
+# %%
+def summary_snapshots(protocol, snapshots, tag):
+    records = [dict(read_run_summary(ss), **snapshot_features(ss)) for ss in snapshots]
+    return summary_records(protocol, records, tag)
 
 
 # %%
-def summary_snapshots(protocol, snapshots, tag, outframe):
+def summary_records(protocol, records, tag):
+    """
+    Per-trial table of the runs of an output directory, one row per run:
+    protocol variables, tag, directory, command, trial, status, uptime [s],
+    error, elt (elapsed millis of bss) and the features of the instance
+    (see experiment.instance_features, NaN if unknown).
+
+    records: summaries of runs (see runner.read_run_summary)
+    """
+    dir = os.path.basename(os.path.dirname(os.path.abspath(protocol)))
     protocol = read_protocol_file(protocol)
     var = protocol["variables"]
-    outframe["field width"].append(var["field width"])
-    outframe["field height"].append(var["field height"])
-    outframe["obstacle width"].append(var["obstacle width"])
-    outframe["obstacle height"].append(var["obstacle height"])
-    outframe["num mobiles"].append(var["num mobiles"])
-    outframe["num statics"].append(var["num statics"])
-    outframe["num obstacles"].append(var["num obstacles"])
-    outframe["tag"].append(tag)
-
-    update_mean_uptime = live_mean()
-    update_err_rate = live_mean()
-    # update_mean_occ = live_mean()
-    update_mean_elt = live_mean()
-    mean_uptime = 0
-    err_rate = 0
-    # mean_occ = 0
-    mean_elt = 0
-
-    for ss in snapshots:
-        with open(ss, mode="r") as f:
-            ss = json.load(f)
-        uptime = ss[-1]["laptime"]
-        if uptime > 0:
-            mean_uptime = update_mean_uptime(uptime)
-        err_rate = update_err_rate(int(uptime == 0))
-        # occ = occupancy_ratio_of_obstacles(ss)
-        # mean_occ = update_mean_occ(occ)
-        assert "elapsed_time_millis_after" in ss[0]
-        elt = ss[0]["elapsed_time_millis_after"]
-        mean_elt = update_mean_elt(elt)
-
-    outframe["mean uptime"].append(mean_uptime)
-    outframe["error rate"].append(err_rate * 100)
-    outframe["mean elt"].append(mean_elt)
-    # outframe["mean occupancy ratio"].append(mean_occ)
-
-
-# %%
-def summary_dir(dir, tag, outframe):
-    files = ["{}/{}".format(dir, f) for f in os.listdir(dir)]
-    protocol_file = "{}/protocol.json".format(dir)
-    assert protocol_file in files
-    files.remove(protocol_file)
-    summary_snapshots(protocol_file, files, tag, outframe)
-
-
-# %%
-def summary_dirs(rootdir, tag):
-    outframe = {
-        "field width": [],
-        "field height": [],
-        "obstacle width": [],
-        "obstacle height": [],
-        "num mobiles": [],
-        "num statics": [],
-        "num obstacles": [],
-        # "occupancy ratio": [],
-        "tag": [],
-        "mean uptime": [],
-        "error rate": [],
-        "mean elt": [],
+    n = len(records)
+    trials = pd.DataFrame(
+        {
+            **{v: var[v] for v in VARIABLES},
+            "tag": tag,
+            "dir": dir,
+            "command": protocol["config"]["command"],
+            "trial": np.arange(n),
+            "status": [r.get("status", "ok") for r in records],
+            "uptime": [r["uptime"] for r in records],
+            "elt": [r["elapsed millis"] for r in records],
+        },
+        index=pd.RangeIndex(n),
+    )
+    trials["uptime"] = trials["uptime"].astype(float)
+    trials["elt"] = trials["elt"].astype(float)
+    trials["error"] = (trials["status"] == "ok") & (trials["uptime"] == 0)
+    for f in INSTANCE_FEATURES:
+        trials[f] = np.array([r.get(f, np.nan) for r in records], dtype=float)
+    return trials
+
+
+# %%
+def aggregate_trials(trials):
+    """
+    The summary of every output directory in a per-trial table: mean uptime
+    of the runs which did not fail (0 if none), error rate [%], mean elt,
+    number of trials and of runs which failed or timed out (see
+    runner.run_solver), which are left out of the statistics, and mean
+    features of the instances of every run, e.g. "mean occupancy ratio".
+    """
+    ok = trials["status"] == "ok"
+    assert trials.loc[ok, "elt"].notna().all()
+    columns = trials[VARIABLES + ["tag", "dir"]].assign(
+        ok=ok,
+        failed=~ok,
+        error=trials["error"],
+        uptime=trials["uptime"].where(ok & (trials["uptime"] > 0)),
+        elt=trials["elt"].where(ok),
+        **{f: trials[f] for f in INSTANCE_FEATURES},
+    )
+    groups = columns.groupby(VARIABLES + ["tag", "dir"], sort=False)
+    sums = groups[["ok", "failed", "error"]].sum()
+    means = groups[["uptime", "elt", *INSTANCE_FEATURES]].mean()
+    summary = pd.DataFrame(
+        {
+            "mean uptime": means["uptime"].fillna(0),
+            "error rate": (sums["error"] / sums["ok"] * 100).fillna(0),
+            "mean elt": means["elt"].fillna(0),
+            "trials": sums["ok"],
+            "failures": sums["failed"],
+            **{"mean {}".format(f): means[f] for f in INSTANCE_FEATURES},
+        }
+    )
+    return summary.reset_index().drop(columns="dir")
+
+
+# %%
+SNAPSHOTS_PER_JOB = 64
+
+
+# %%
+SUMMARY_INDEX = ".summary-index.sqlite"
+
+
+# %%
+def open_summary_index(path):
+    """
+    Index of the records of snapshots, keyed by path, size and mtime, so
+    that summaries only parse new or modified snapshots.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS snapshots ("
+        " path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime_ns INTEGER,"
+        " record TEXT)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS snapshots_dir ON snapshots (dir)")
+    return conn
+
+
+# %%
+def snapshot_files(dir):
+    """
+    (path, size, mtime_ns) of the snapshots of dir, sorted by path.
+    """
+    files = []
+    for e in os.scandir(dir):
+        if e.name.startswith("snapshot-") and e.name.endswith(SNAPSHOT_SUFFIXES):
+            st = e.stat()
+            files.append((e.path, st.st_size, st.st_mtime_ns))
+    return sorted(files)
+
+
+# %%
+def indexed_records(index, dir, files):
+    """
+    Records of the files whose size and mtime are the ones in the index,
+    and whether the index holds exactly these files. Records with features
+    of another version are left out, to be parsed again.
+    """
+    if index is None:
+        return {}, False
+    stats = {path: (size, mtime_ns) for path, size, mtime_ns in files}
+    rows = index.execute(
+        "SELECT path, size, mtime_ns, record FROM snapshots WHERE dir = ?", (dir,)
+    ).fetchall()
+    known = {
+        path: json.loads(record)
+        for path, size, mtime_ns, record in rows
+        if stats.get(path) == (size, mtime_ns)
+    }
+    known = {
+        path: record
+        for path, record in known.items()
+        if record.get("features version") == FEATURES_VERSION
     }
-    for dir in os.listdir(rootdir):
-        dir = "{}/{}".format(rootdir, dir)
-        summary_dir(dir, tag, outframe)
-    return outframe
+    return known, len(rows) == len(known) == len(files)
+
+
+# %%
+def update_index(index, dir, files, records):
+    with index:
+        index.execute("DELETE FROM snapshots WHERE dir = ?", (dir,))
+        index.executemany(
+            "INSERT INTO snapshots VALUES (?, ?, ?, ?, ?)",
+            [
+                (path, dir, size, mtime_ns, json.dumps(record))
+                for (path, size, mtime_ns), record in zip(files, records)
+            ],
+        )
+
+
+# %%
+def read_records(job):
+    """
+    Summaries of a chunk of snapshots of a directory, or of its run index,
+    with the features of their instances.
+    """
+    dir, files = job
+    if files is None:
+        return [record_features(dir, r) for r in read_run_index(dir)]
+    return [dict(read_run_summary(f), **snapshot_features(f)) for f in files]
+
+
+# %%
+def summary_jobs(dirs, index, listing):
+    """
+    (dir, files) jobs of read_records, for the snapshots missing from the
+    index, listing each directory only once its jobs are pulled. files is
+    None for directories with a run index. The snapshots of every
+    directory and their indexed records go to listing[dir].
+    """
+    for dir in dirs:
+        assert os.path.exists("{}/protocol.json".format(dir))
+        # Summaries recorded at run time spare parsing the snapshots
+        if os.path.exists("{}/{}".format(dir, RUN_INDEX)):
+            listing[dir] = None
+            yield dir, None
+            continue
+        files = snapshot_files(dir)
+        known, up_to_date = indexed_records(index, dir, files)
+        listing[dir] = (files, known, up_to_date)
+        missing = [path for path, _, _ in files if path not in known]
+        for i in range(0, max(len(missing), 1), SNAPSHOTS_PER_JOB):
+            yield dir, missing[i : i + SNAPSHOTS_PER_JOB]
+
+
+# %%
+def summary_dir(dir, tag):
+    return summary_trials([dir], tag, workers=1)
+
+
+# %%
+def summary_trials(dirs, tag, workers=None, index=None):
+    """
+    Per-trial table (see summary_records) of dirs, in the order of dirs.
+    Snapshots are parsed on a pool of processes, and only the records of
+    the directories being summarized are held besides the table. With an
+    index (see open_summary_index), only snapshots missing from it are
+    parsed, and the index is updated.
+    """
+    frames = []
+    workers = workers or os.cpu_count()
+    listing = {}
+    jobs = summary_jobs(dirs, index, listing)
+    results = run_jobs(read_records, jobs, workers, ProcessPoolExecutor)
+
+    def summarize(dir, parsed):
+        protocol_file = "{}/protocol.json".format(dir)
+        if listing[dir] is None:
+            frames.append(summary_records(protocol_file, parsed, tag))
+            del listing[dir]
+            return
+        files, known, up_to_date = listing.pop(dir)
+        # Parsed records come in the order of the snapshots missing from known
+        parsed = iter(parsed)
+        records = [
+            known[path] if path in known else next(parsed) for path, _, _ in files
+        ]
+        if index is not None and not up_to_date:
+            update_index(index, dir, files, records)
+        frames.append(summary_records(protocol_file, records, tag))
+
+    # Jobs of a directory come in a row, so that it is summarized as soon as
+    # the first job of the next directory comes
+    current, parsed = None, []
+    for (dir, _), chunk in results:
+        if dir != current and current is not None:
+            summarize(current, parsed)
+            parsed = []
+        current = dir
+        parsed += chunk
+    if current is not None:
+        summarize(current, parsed)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=TRIAL_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+# %%
+def summary_dirs(rootdir, tag, workers=None):
+    """
+    Per-trial table of the output directories in rootdir. Records parsed
+    from snapshots are kept in {rootdir}/.summary-index.sqlite, so that a
+    new pass only parses the snapshots added or modified since the last one.
+    """
+    dirs = sorted(os.path.abspath(e.path) for e in os.scandir(rootdir) if e.is_dir())
+    index = open_summary_index("{}/{}".format(rootdir, SUMMARY_INDEX))
+    try:
+        return summary_trials(dirs, tag, workers, index)
+    finally:
+        index.close()
 
 
 # %%
-def summary(outfile, rootdir, tag):
-    df = summary_dirs(rootdir, tag)
-    df = pd.DataFrame(df)
-    df.to_csv(outfile, index=False)
+def summary(outfile, rootdir, tag, workers=None):
+    """
+    Write the summary of every output directory to outfile, and the
+    per-trial table they are computed from next to it, e.g. to
+    robustness-single.trials.csv for robustness-single.csv.
+    """
+    trials = summary_dirs(rootdir, tag, workers)
+    aggregate_trials(trials).to_csv(outfile, index=False)
+    trials.to_csv("{}.trials.csv".format(os.path.splitext(outfile)[0]), index=False)
 
 
 # %%
@@ -113,4 +361,5 @@ if __name__ == "__main__":
     rootdir = sys.argv[1]
     tag = sys.argv[2]
     outfile = sys.argv[3]
-    summary(outfile, rootdir, tag)
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    summary(outfile, rootdir, tag, workers)
@@ -0,0 +1,183 @@
+# %%
+import json
+import math
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+
+# Histograms have one bucket per power of two of microseconds
+BUCKETS = 40
+
+stages = {}
+lock = threading.Lock()
+enabled = False
+started_at = None
+profiler = None
+
+
+# %%
+def enable(profile=False):
+    """
+    Start timing stages (see stage); until then, stage() does nothing.
+    With profile, blocks run under profiled() are profiled too.
+    """
+    global enabled, started_at, profiler
+    with lock:
+        stages.clear()
+        enabled = True
+        started_at = time.perf_counter()
+        profiler = cProfile.Profile() if profile else None
+
+
+# %%
+def disable():
+    """
+    Stop timing stages, e.g. once the report of an experiment is written,
+    so that later experiments of the same process are not timed.
+    """
+    global enabled, profiler
+    with lock:
+        enabled = False
+        profiler = None
+
+
+# %%
+def record(name, seconds):
+    bucket = min(max(math.frexp(seconds * 1e6)[1], 0), BUCKETS - 1)
+    with lock:
+        if name not in stages:
+            stages[name] = {
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "histogram": [0] * BUCKETS,
+            }
+        s = stages[name]
+        s["count"] += 1
+        s["total"] += seconds
+        s["max"] = max(s["max"], seconds)
+        s["histogram"][bucket] += 1
+
+
+# %%
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time the block as one occurrence of the stage `name`, if enabled.
+    Stages may be timed from any thread.
+    """
+    if not enabled:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t)
+
+
+# %%
+def percentile(histogram, count, q):
+    """
+    Upper bound [s] of the bucket holding the q-quantile (report caps it
+    to the maximum).
+    """
+    n = 0
+    for i, c in enumerate(histogram):
+        n += c
+        if n >= q * count:
+            return 2.0 ** i / 1e6
+    return math.inf
+
+
+# %%
+def report():
+    """
+    Breakdown of the time spent in every stage since enable(). Stages timed
+    from several threads at once may add up to more than the wall time.
+    """
+    with lock:
+        wall_time = time.perf_counter() - started_at
+        breakdown = {}
+        for name, s in stages.items():
+            p50 = percentile(s["histogram"], s["count"], 0.5)
+            p99 = percentile(s["histogram"], s["count"], 0.99)
+            breakdown[name] = {
+                "count": s["count"],
+                "total [s]": s["total"],
+                "mean [ms]": s["total"] / s["count"] * 1e3,
+                "p50 [ms]": min(p50, s["max"]) * 1e3,
+                "p99 [ms]": min(p99, s["max"]) * 1e3,
+                "max [ms]": s["max"] * 1e3,
+                "wall share [%]": s["total"] / wall_time * 100,
+                "histogram [us, 2^i]": list(s["histogram"]),
+            }
+    return {"wall time [s]": wall_time, "stages": breakdown}
+
+
+# %%
+def format_table(breakdown):
+    header = ["count", "total [s]", "mean [ms]", "p50 [ms]", "p99 [ms]", "max [ms]"]
+    lines = [
+        "{:<20} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>8}".format(
+            "stage", *header, "wall %"
+        )
+    ]
+    stages = sorted(
+        breakdown["stages"].items(), key=lambda kv: kv[1]["total [s]"], reverse=True
+    )
+    for name, s in stages:
+        lines.append(
+            "{:<20} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>8.1f}".format(
+                name,
+                s["count"],
+                s["total [s]"],
+                s["mean [ms]"],
+                s["p50 [ms]"],
+                s["p99 [ms]"],
+                s["max [ms]"],
+                s["wall share [%]"],
+            )
+        )
+    lines.append("wall time: {:.2f} s".format(breakdown["wall time [s]"]))
+    return "\n".join(lines)
+
+
+# %%
+def write_report(path):
+    """
+    Write the breakdown to {path}.json and as a table to {path}.txt, and
+    print the table. The profile, if any, goes to {path}.prof and its top
+    functions by cumulative time to {path}-profile.txt.
+    """
+    breakdown = report()
+    table = format_table(breakdown)
+    with open("{}.json".format(path), mode="w") as f:
+        json.dump(breakdown, f, indent=2)
+    with open("{}.txt".format(path), mode="w") as f:
+        f.write(table + "\n")
+    print(table)
+    if profiler is not None:
+        profiler.dump_stats("{}.prof".format(path))
+        with open("{}-profile.txt".format(path), mode="w") as f:
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(30)
+
+
+# %%
+@contextlib.contextmanager
+def profiled():
+    """
+    Run the block under cProfile if enabled with profile, accumulating into
+    the profile written by write_report. Only the calling thread (of the
+    current process) is profiled.
+    """
+    if profiler is None:
+        yield
+        return
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    problem INTEGER NOT NULL,
+    trial INTEGER NOT NULL,
+    args TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS results (
+    job_id INTEGER PRIMARY KEY,
+    row TEXT NOT NULL
+);
+"""
+
+
+def open_queue(path):
+    """
+    A queue of (problem, trial, solver args) jobs in a SQLite file, which
+    workers on any host sharing the file lease jobs from.
+    """
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def enqueue(conn, jobs):
+    """
+    jobs: list of (problem, trial, args), in the order results are merged
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany(
+        "INSERT INTO jobs (problem, trial, args) VALUES (?, ?, ?)",
+        [(problem, trial, args) for problem, trial, args in jobs],
+    )
+    conn.execute("COMMIT")
+
+
+def lease(conn, owner, duration, max_attempts=3):
+    """
+    Lease a pending job, or a job whose lease has expired (its worker died).
+    Jobs whose lease expired after max_attempts leases are failed instead.
+    Returns (id, problem, trial, args, attempts), or None if no job is left
+    to lease.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(
+        "UPDATE jobs SET state = 'failed', lease_until = NULL"
+        " WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+        (now, max_attempts),
+    )
+    job = conn.execute(
+        "SELECT id, problem, trial, args, attempts + 1 FROM jobs"
+        " WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)"
+        " ORDER BY id LIMIT 1",
+        (now,),
+    ).fetchone()
+    if job is not None:
+        conn.execute(
+            "UPDATE jobs SET state = 'leased', owner = ?, lease_until = ?,"
+            " attempts = attempts + 1 WHERE id = ?",
+            (owner, now + duration, job[0]),
+        )
+    conn.execute("COMMIT")
+    return job
+
+
+def renew(conn, job_id, owner, duration):
+    """
+    Extend the lease of a job; False if the job was given to another worker.
+    """
+    cur = conn.execute(
+        "UPDATE jobs SET lease_until = ?"
+        " WHERE id = ? AND owner = ? AND state = 'leased'",
+        (time.time() + duration, job_id, owner),
+    )
+    return cur.rowcount == 1
+
+
+def complete(conn, job_id, owner, row):
+    """
+    Store the result row of a job. Results of a worker which lost its lease
+    are dropped if the job was completed by another worker in the meantime.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(
+        "INSERT OR IGNORE INTO results (job_id, row) VALUES (?, ?)",
+        (job_id, json.dumps(row)),
+    )
+    conn.execute(
+        "UPDATE jobs SET state = 'done', owner = ?, lease_until = NULL WHERE id = ?",
+        (owner, job_id),
+    )
+    conn.execute("COMMIT")
+
+
+def release(conn, job_id, owner):
+    """
+    Give a leased job back to the queue, e.g. after its run raised.
+    """
+    conn.execute(
+        "UPDATE jobs SET state = 'pending', owner = NULL, lease_until = NULL"
+        " WHERE id = ? AND owner = ? AND state = 'leased'",
+        (job_id, owner),
+    )
+
+
+def fail(conn, job_id, owner, row):
+    """
+    Store the result row of a job which is not run again.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(
+        "INSERT OR IGNORE INTO results (job_id, row) VALUES (?, ?)",
+        (job_id, json.dumps(row)),
+    )
+    conn.execute(
+        "UPDATE jobs SET state = 'failed', owner = ?, lease_until = NULL"
+        " WHERE id = ? AND state != 'done'",
+        (owner, job_id),
+    )
+    conn.execute("COMMIT")
+
+
+def pending_jobs(conn):
+    return conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE state NOT IN ('done', 'failed')"
+    ).fetchone()[0]
+
+
+def failed_jobs(conn):
+    return conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE state = 'failed'"
+    ).fetchone()[0]
+
+
+def results(conn):
+    """
+    Result rows in the order of jobs.
+    """
+    return [
+        json.loads(row)
+        for (row,) in conn.execute("SELECT row FROM results ORDER BY job_id")
+    ]